@@ -1,21 +1,33 @@
-import os
-
 import streamlit as st
+from components.diff_list import show_diff_list
 from components.entry_modal import show_entry_details
-from pykeepass import PyKeePass
+from components.profile_panel import show_profile
 
 from KeePassDiff.utils.comparison import compare_databases
 from KeePassDiff.utils.database import (
-    get_entries_set,
+    DatabaseCache,
     get_entry_details,
-    merge_entry,
-    save_temp_database,
+    index_database,
+    export_database,
+    merge_entries,
+    merge_group,
+)
+from KeePassDiff.utils.listing import PathListing
+from KeePassDiff.utils.profiling import Profiler, span
+from KeePassDiff.utils.snapshot import (
+    hash_binaries,
+    history_changes,
+    snapshot_database,
+    snapshot_entry,
 )
+from KeePassDiff.utils.unlock import unlock_cached
 
 st.set_page_config(page_title="KeePassDiff", page_icon="🔐", layout="wide")
 
+IDLE_TIMEOUT = 15 * 60
 
-def main():
+
+def show_diff():
     st.title("🔐 KeePassDiff")
 
     st.header("Databases")
@@ -41,6 +53,26 @@ def main():
             "Key file for second database (optional)", key="key2"
         )
 
+    if "database_cache" not in st.session_state:
+        st.session_state["database_cache"] = DatabaseCache(IDLE_TIMEOUT)
+    cache = st.session_state["database_cache"]
+
+    # Idle databases are dropped with their keys, and with any merges made
+    if cache.expire():
+        st.session_state.pop("diff_state", None)
+        st.info(
+            f"Databases were locked after {IDLE_TIMEOUT // 60} idle minutes, "
+            "merges that were not exported are discarded"
+        )
+
+    # Drop unlocked databases as soon as their upload is removed
+    if not db1_file:
+        cache.evict("db1")
+    if not db2_file:
+        cache.evict("db2")
+    if not (db1_file and db2_file):
+        st.session_state.pop("diff_state", None)
+
     if not (db1_file and db2_file and db1_password and db2_password):
         st.warning("You need to open two databases to diff them")
         return
@@ -54,19 +86,327 @@ def main():
         else:
             st.session_state["expanded_entries"].add(key)
 
+    def toggle_staged(name, entry):
+        staged = st.session_state.setdefault(name, set())
+        if entry in staged:
+            staged.remove(entry)
+        else:
+            staged.add(entry)
+
+    def merge_sides(side):
+        # (source, target, source index, target index, diff) for merges from side
+        kp1, kp2, index1, index2, differences, listings = st.session_state["diff_state"]
+        # The merge changes the lists, they are built again on the next run
+        listings.clear()
+        if side == 1:
+            return kp1, kp2, index1, index2, differences
+        return kp2, kp1, index2, index1, differences
+
+    def apply_staged(name, side, label):
+        staged = sorted(st.session_state.pop(name, set()))
+        source, target, source_index, target_index, differences = merge_sides(side)
+        # Nothing is written until export, which serializes the merged state once
+        merged = merge_entries(
+            source,
+            target,
+            staged,
+            source_index,
+            target_index,
+            save=False,
+            preserve_uuids=st.session_state.get("preserve_uuids", False),
+        )
+        # Only the merged paths move in the diff, nothing is compared again
+        binary_hashes = hash_binaries(target)
+        for entry_path in merged:
+            differences.apply_merge(
+                entry_path,
+                side,
+                snapshot_entry(
+                    target_index.entries[entry_path], entry_path, binary_hashes
+                ),
+            )
+        st.session_state["merge_message"] = (
+            f"Merged {len(merged)} entries to {label} database"
+        )
+
+    def apply_group(group_path, side, label):
+        source, target, source_index, target_index, differences = merge_sides(side)
+        copied = merge_group(
+            source,
+            target,
+            group_path,
+            source_index,
+            target_index,
+            preserve_uuids=st.session_state.get("preserve_uuids", False),
+            save=False,
+        )
+        binary_hashes = hash_binaries(target)
+        snapshots = {
+            entry_path: snapshot_entry(
+                target_index.entries[entry_path], entry_path, binary_hashes
+            )
+            for entry_path in copied
+        }
+        if not differences.apply_group_merge(group_path, side, snapshots):
+            # Compared again on the next run
+            st.session_state.pop("diff_state")
+        st.session_state["merge_message"] = (
+            f"Merged group {group_path} with {len(copied)} entries to {label} database"
+        )
+
+    uploads = {
+        "db1": (db1_file, db1_password, db1_keyfile),
+        "db2": (db2_file, db2_password, db2_keyfile),
+    }
+    progress = st.progress(0.0, text="Unlocking databases...")
+    unlocked = []
+
+    def on_unlocked(result):
+        unlocked.append(result.name)
+        progress.progress(
+            len(unlocked) / len(uploads),
+            text=f"Unlocked {len(unlocked)} of {len(uploads)} databases...",
+        )
+
+    results = unlock_cached(cache, uploads, on_unlocked=on_unlocked)
+    progress.empty()
+
+    failed = False
+    for label, result in zip(("first", "second"), results.values()):
+        if result.error is not None:
+            st.error(f"Error opening {label} database: {str(result.error)}")
+            failed = True
+    if failed:
+        return
+
     try:
-        tmp1_name, tmp1_keyfile = save_temp_database(db1_file, db1_keyfile)
-        tmp2_name, tmp2_keyfile = save_temp_database(db2_file, db2_keyfile)
+        kp1 = results["db1"].kp
+        kp2 = results["db2"].kp
 
-        try:
-            kp1 = PyKeePass(tmp1_name, password=db1_password, keyfile=tmp1_keyfile)
-            kp2 = PyKeePass(tmp2_name, password=db2_password, keyfile=tmp2_keyfile)
+        # The diff is kept across reruns and only rebuilt for other databases
+        state = st.session_state.get("diff_state")
+        if state is None or state[0] is not kp1 or state[1] is not kp2:
+            index1 = index_database(kp1)
+            index2 = index_database(kp2)
+            differences = compare_databases(
+                index1.as_sets(),
+                index2.as_sets(),
+                snapshot_database(kp1),
+                snapshot_database(kp2),
+            )
+            state = (kp1, kp2, index1, index2, differences, {})
+            st.session_state["diff_state"] = state
+        _, _, index1, index2, differences, listings = state
 
-            db1_data = get_entries_set(kp1)
-            db2_data = get_entries_set(kp2)
-            differences = compare_databases(db1_data, db2_data)
+        def listing(name, paths):
+            # Filtering and paging reuse the listing built for this diff
+            if name not in listings:
+                listings[name] = PathListing(paths)
+            return listings[name]
 
+        def keep_alive():
+            # Fragment reruns skip the unlock, so they mark the databases as
+            # used here. Once they are locked the whole app runs again.
+            if not cache.touch("db1", "db2"):
+                st.rerun()
+
+        with span("render"):
             st.header("Diff Results")
+            if "merge_message" in st.session_state:
+                st.success(st.session_state.pop("merge_message"))
+
+            def show_entry_button(kp, index, entry, view_key, label, details_key=None):
+                st.button(
+                    label,
+                    key=view_key,
+                    on_click=toggle_entry,
+                    args=(view_key,),
+                )
+                if view_key in st.session_state["expanded_entries"]:
+                    entry_details = get_entry_details(kp, entry, index)
+                    show_entry_details(entry_details, key=details_key or view_key)
+
+            def show_exclusive_entry(kp, index, entry, side, stage_label, staged_name):
+                col_entry, col_stage = st.columns([4, 1])
+                with col_entry:
+                    show_entry_button(
+                        kp, index, entry, f"view{side}_{entry}", f"📝 {entry}"
+                    )
+                with col_stage:
+                    st.checkbox(
+                        stage_label,
+                        value=entry in st.session_state.get(staged_name, set()),
+                        key=f"{staged_name}_{entry}",
+                        on_change=toggle_staged,
+                        args=(staged_name, entry),
+                    )
+
+            def show_exclusive_group(group_path, side, button_label, label):
+                col_group, col_merge = st.columns([4, 1])
+                with col_group:
+                    st.info(group_path)
+                with col_merge:
+                    if st.button(button_label, key=f"merge_group{side}_{group_path}"):
+                        apply_group(group_path, side, label)
+                        # Both sides of the diff changed
+                        st.rerun()
+
+            def show_changed_entry(entry):
+                st.markdown(
+                    f"**{entry}** differs in: "
+                    + ", ".join(differences["field_deltas"][entry])
+                )
+                if "history" in differences["field_deltas"][entry]:
+                    only1, only2 = history_changes(
+                        differences.snapshots[1][entry], differences.snapshots[2][entry]
+                    )
+                    st.caption(
+                        f"History: {only1} revisions only in DB1, "
+                        f"{only2} only in DB2"
+                    )
+                col1, col2 = st.columns([1, 1])
+                with col1:
+                    view_key = f"view1_common_{entry}"
+                    show_entry_button(
+                        kp1,
+                        index1,
+                        entry,
+                        view_key,
+                        f"📝 View in DB1: {entry}",
+                        view_key + "_common_1",
+                    )
+                with col2:
+                    view_key = f"view2_common_{entry}"
+                    show_entry_button(
+                        kp2,
+                        index2,
+                        entry,
+                        view_key,
+                        f"📝 View in DB2: {entry}",
+                        view_key + "_common_2",
+                    )
+
+            # Every panel below is a fragment. Expanding an entry, staging,
+            # filtering or paging reruns only its panel, while merges rerun
+            # the whole app so that every panel shows the new diff.
+            @st.fragment
+            def show_exclusive_entries(
+                side, kp, index, stage_label, staged_name, apply_key, apply_label
+            ):
+                keep_alive()
+                paths = differences[f"entries_only_in_db{side}"]
+                show_diff_list(
+                    listing(f"only_{side}", paths),
+                    lambda entry: show_exclusive_entry(
+                        kp, index, entry, side, stage_label, staged_name
+                    ),
+                    key=f"list_only_{side}",
+                )
+                staged = len(st.session_state.get(staged_name, ()))
+                if paths and st.button(apply_label.format(staged), key=apply_key):
+                    apply_staged(staged_name, side, "second" if side == 1 else "first")
+                    st.rerun()
+
+            @st.fragment
+            def show_exclusive_groups(side, button_label):
+                keep_alive()
+                show_diff_list(
+                    listing(
+                        f"groups_only_{side}", differences[f"groups_only_in_db{side}"]
+                    ),
+                    lambda group: show_exclusive_group(
+                        group, side, button_label, "second" if side == 1 else "first"
+                    ),
+                    key=f"list_groups_{side}",
+                )
+
+            @st.fragment
+            def show_changed_entries():
+                keep_alive()
+                show_diff_list(
+                    listing("changed", differences["changed_entries"]),
+                    show_changed_entry,
+                    key="list_changed",
+                )
+
+            @st.fragment
+            def show_changed_groups(group_tree):
+                keep_alive()
+                show_diff_list(
+                    listing(
+                        "groups_changed",
+                        [path for path in group_tree["groups_changed"] if path],
+                    ),
+                    st.warning,
+                    key="list_groups",
+                )
+
+            # Pairs are listed by their path in the first database
+            @st.fragment
+            def show_moved_entries():
+                keep_alive()
+                moved = dict(differences["moved_entries"])
+
+                def show_moved_entry(old_path):
+                    fields = differences["field_deltas"][old_path]
+                    st.info(
+                        f"{old_path} ➡️ {moved[old_path]}"
+                        + (f" (also differs in: {', '.join(fields)})" if fields else "")
+                    )
+
+                show_diff_list(
+                    listing("moved", list(moved)), show_moved_entry, key="list_moved"
+                )
+
+            @st.fragment
+            def show_similar_entries():
+                keep_alive()
+                similar = {}
+                for old_path, new_path, score in differences["similar_entries"]:
+                    similar.setdefault(old_path, []).append((new_path, score))
+
+                def show_similar_entry(old_path):
+                    for new_path, score in similar[old_path]:
+                        st.info(f"{old_path} ➡️ {new_path} ({score:.0%} similar)")
+
+                show_diff_list(
+                    listing("similar", list(similar)),
+                    show_similar_entry,
+                    key="list_similar",
+                )
+
+            @st.fragment
+            def show_moved_groups(group_tree):
+                keep_alive()
+                moved = dict(group_tree["groups_moved"])
+                show_diff_list(
+                    listing("groups_moved", list(moved)),
+                    lambda old_path: st.info(f"{old_path} ➡️ {moved[old_path]}"),
+                    key="list_groups_moved",
+                )
+
+            @st.fragment
+            def show_export():
+                keep_alive()
+                col1, col2 = st.columns(2)
+
+                with col1:
+                    if st.button("Export using First DB as base"):
+                        st.download_button(
+                            "Save merged database (DB1 base)",
+                            export_database(kp1, results["db1"].transformed_key),
+                            file_name="merged_db1_base.kdbx",
+                            mime="application/x-keepass",
+                        )
+
+                with col2:
+                    if st.button("Export using Second DB as base"):
+                        st.download_button(
+                            "Save merged database (DB2 base)",
+                            export_database(kp2, results["db2"].transformed_key),
+                            file_name="merged_db2_base.kdbx",
+                            mime="application/x-keepass",
+                        )
 
             tabs = st.tabs(["Exclusive Entries", "Conflicting Items", "Merge & Export"])
             with tabs[0]:
@@ -74,150 +414,86 @@ def main():
 
                 with col1:
                     st.subheader("Entries only in first database")
-                    if differences["entries_only_in_db1"]:
-                        for entry in differences["entries_only_in_db1"]:
-                            col1_1, col1_2 = st.columns([4, 1])
-                            with col1_1:
-                                view_key = f"view1_{entry}"
-                                st.button(
-                                    f"📝 {entry}",
-                                    key=view_key,
-                                    on_click=toggle_entry,
-                                    args=(view_key,),
-                                )
-                                if view_key in st.session_state["expanded_entries"]:
-                                    entry_details = get_entry_details(kp1, entry)
-                                    show_entry_details(entry_details, key=view_key)
-                            with col1_2:
-                                if st.button(
-                                    "Merge right ➡️", key=f"merge_right_{entry}"
-                                ):
-                                    if merge_entry(kp1, kp2, entry):
-                                        st.success(f"Merged {entry} to second database")
-                                        kp2.save()
-                    else:
-                        st.write("None")
+                    show_exclusive_entries(
+                        1,
+                        kp1,
+                        index1,
+                        "Stage ➡️",
+                        "staged_right",
+                        "apply_right",
+                        "Merge {} staged right ➡️",
+                    )
 
                     st.subheader("Groups only in first database")
-                    if differences["groups_only_in_db1"]:
-                        for group in differences["groups_only_in_db1"]:
-                            st.info(group)
-                    else:
-                        st.write("None")
+                    show_exclusive_groups(1, "Merge ➡️")
 
                 with col2:
                     st.subheader("Entries only in second database")
-                    if differences["entries_only_in_db2"]:
-                        for entry in differences["entries_only_in_db2"]:
-                            col2_1, col2_2 = st.columns([4, 1])
-                            with col2_1:
-                                view_key = f"view2_{entry}"
-                                st.button(
-                                    f"📝 {entry}",
-                                    key=view_key,
-                                    on_click=toggle_entry,
-                                    args=(view_key,),
-                                )
-                                if view_key in st.session_state["expanded_entries"]:
-                                    entry_details = get_entry_details(kp2, entry)
-                                    show_entry_details(entry_details, key=view_key)
-                            with col2_2:
-                                if st.button("⬅️ Merge left", key=f"merge_left_{entry}"):
-                                    if merge_entry(kp2, kp1, entry):
-                                        st.success(f"Merged {entry} to first database")
-                                        kp1.save()
-                    else:
-                        st.write("None")
+                    show_exclusive_entries(
+                        2,
+                        kp2,
+                        index2,
+                        "⬅️ Stage",
+                        "staged_left",
+                        "apply_left",
+                        "⬅️ Merge {} staged left",
+                    )
 
                     st.subheader("Groups only in second database")
-                    if differences["groups_only_in_db2"]:
-                        for group in differences["groups_only_in_db2"]:
-                            st.warning(group)
-                    else:
-                        st.write("None")
+                    show_exclusive_groups(2, "⬅️ Merge")
+
+                st.checkbox(
+                    "Keep the UUIDs of merged entries and groups",
+                    key="preserve_uuids",
+                )
 
             with tabs[1]:
                 st.subheader("Conflicting Entries")
-                if differences["common_entries"]:
-                    for entry in differences["common_entries"]:
-                        col1, col2 = st.columns([1, 1])
-                        with col1:
-                            view_key = f"view1_common_{entry}"
-                            st.button(
-                                f"📝 View in DB1: {entry}",
-                                key=view_key,
-                                on_click=toggle_entry,
-                                args=(view_key,),
-                            )
-                            if view_key in st.session_state["expanded_entries"]:
-                                int_key = view_key + "_common_1"
-                                entry_details = get_entry_details(kp1, entry)
-                                show_entry_details(entry_details, key=int_key)
-                        with col2:
-                            view_key = f"view2_common_{entry}"
-                            st.button(
-                                f"📝 View in DB2: {entry}",
-                                key=view_key,
-                                on_click=toggle_entry,
-                                args=(view_key,),
-                            )
-                            if view_key in st.session_state["expanded_entries"]:
-                                int_key = view_key + "_common_2"
-                                entry_details = get_entry_details(kp2, entry)
-                                show_entry_details(entry_details, key=int_key)
-                else:
-                    st.write("No common entries found")
+                st.caption(
+                    f"{len(differences['identical_entries'])} common entries are "
+                    "identical in both databases"
+                )
+                show_changed_entries()
+
+                st.subheader("Moved or Renamed Entries")
+                show_moved_entries()
+
+                st.subheader("Possibly Renamed Entries")
+                st.caption(
+                    "Entries without a shared UUID that look alike, they are "
+                    "still listed as exclusive"
+                )
+                show_similar_entries()
+
+                group_tree = differences["group_tree"]
+                st.subheader("Moved or Renamed Groups")
+                show_moved_groups(group_tree)
 
                 st.subheader("Conflicting Groups")
-                if differences["common_groups"]:
-                    for group in differences["common_groups"]:
-                        st.success(group)
-                else:
-                    st.write("No common groups found")
+                st.caption(
+                    f"{group_tree['identical_subtrees']} group subtrees are "
+                    "identical in both databases"
+                )
+                show_changed_groups(group_tree)
 
             with tabs[2]:
                 st.subheader("Export Merged Database")
-                col1, col2 = st.columns(2)
-
-                with col1:
-                    if st.button("Export using First DB as base"):
-                        merged_db_path = "merged_db1_base.kdbx"
-                        kp1.save(merged_db_path)
-                        with open(merged_db_path, "rb") as f:
-                            st.download_button(
-                                "Save merged database (DB1 base)",
-                                f,
-                                file_name="merged_db1_base.kdbx",
-                                mime="application/x-keepass",
-                            )
-
-                with col2:
-                    if st.button("Export using Second DB as base"):
-                        merged_db_path = "merged_db2_base.kdbx"
-                        kp2.save(merged_db_path)
-                        with open(merged_db_path, "rb") as f:
-                            st.download_button(
-                                "Save merged database (DB2 base)",
-                                f,
-                                file_name="merged_db2_base.kdbx",
-                                mime="application/x-keepass",
-                            )
-
-        except Exception as e:
-            st.error(f"Error opening databases: {str(e)}")
-
-        finally:
-            # Cleanup temporary files
-            os.unlink(tmp1_name)
-            os.unlink(tmp2_name)
-            if tmp1_keyfile:
-                os.unlink(tmp1_keyfile)
-            if tmp2_keyfile:
-                os.unlink(tmp2_keyfile)
+                show_export()
 
     except Exception as e:
         st.error(f"An error occurred: {str(e)}")
 
 
+def main():
+    if not st.sidebar.checkbox("Show profiling", key="profiling"):
+        show_diff()
+        return
+
+    profiler = Profiler()
+    with profiler.activate():
+        show_diff()
+    show_profile(profiler)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,463 @@
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Dict, Iterator, List, Optional
+
+from KeePassDiff.utils.batch import read_manifest, run_jobs
+from KeePassDiff.utils.comparison import compare_databases, compare_many
+from KeePassDiff.utils.database import (
+    index_database,
+    merge_entries,
+    save_database,
+    update_entry,
+)
+from KeePassDiff.utils.profiling import Profiler
+from KeePassDiff.utils.snapshot import snapshot_database
+from KeePassDiff.utils.threeway import merge_three_way
+from KeePassDiff.utils.unlock import UnlockRequest, unlock_databases
+from KeePassDiff.utils.watch import VaultWatcher
+
+COMMANDS = ("diff", "merge", "watch", "batch")
+POLICIES = ("union", "newest")
+
+
+def _emit(event: Dict, stream=None):
+    stream = stream or sys.stdout
+    stream.write(json.dumps(event, default=str) + "\n")
+    stream.flush()
+
+
+def diff_events(differences: Dict) -> Iterator[Dict]:
+    for db, key in ((1, "entries_only_in_db1"), (2, "entries_only_in_db2")):
+        for entry_path in differences[key]:
+            yield {"event": "entry_only", "db": db, "path": entry_path}
+    for old_path, new_path in differences.get("moved_entries", []):
+        yield {
+            "event": "entry_moved",
+            "from": old_path,
+            "to": new_path,
+            "fields": differences["field_deltas"][old_path],
+        }
+    for old_path, new_path, score in differences.get("similar_entries", []):
+        yield {
+            "event": "entry_similar",
+            "from": old_path,
+            "to": new_path,
+            "score": score,
+        }
+    for entry_path in differences.get("changed_entries", []):
+        yield {
+            "event": "entry_changed",
+            "path": entry_path,
+            "fields": differences["field_deltas"][entry_path],
+        }
+    for db, key in ((1, "groups_only_in_db1"), (2, "groups_only_in_db2")):
+        for group_path in differences[key]:
+            yield {"event": "group_only", "db": db, "path": group_path}
+    if "moved_entries" in differences:
+        # Whole subtrees that moved, found by the group tree diff
+        for old_path, new_path in differences["group_tree"]["groups_moved"]:
+            yield {"event": "group_moved", "from": old_path, "to": new_path}
+
+
+def _summary(differences: Dict) -> Dict:
+    return {
+        "event": "summary",
+        **{
+            key: len(differences[key])
+            for key in (
+                "entries_only_in_db1",
+                "entries_only_in_db2",
+                "identical_entries",
+                "changed_entries",
+                "moved_entries",
+                "similar_entries",
+                "groups_only_in_db1",
+                "groups_only_in_db2",
+            )
+        },
+        "groups_moved": len(differences["group_tree"]["groups_moved"]),
+    }
+
+
+def read_passwords(
+    count: int, env_vars: Optional[List[str]] = None, use_stdin: bool = False
+) -> List[str]:
+    # One value per database in order, the last one repeats for the rest
+    if use_stdin:
+        values = [line.rstrip("\r\n") for line in sys.stdin.readlines()]
+        values = [value for value in values if value]
+    else:
+        env_vars = env_vars or ["KPD_PASSWORD"]
+        values = [os.environ.get(name) for name in env_vars]
+        missing = [name for name, value in zip(env_vars, values) if not value]
+        if missing:
+            raise ValueError(f"Password variable not set: {', '.join(missing)}")
+    if not values:
+        raise ValueError("No password given")
+    return (values + [values[-1]] * count)[:count]
+
+
+def _read_optional(path: Optional[str]) -> Optional[bytes]:
+    if not path:
+        return None
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _unlock(args) -> List:
+    # The common ancestor of a three-way merge comes last
+    paths = args.databases + ([args.base] if getattr(args, "base", None) else [])
+    passwords = read_passwords(len(paths), args.password_env, args.password_stdin)
+    return _unlock_paths(paths, passwords, args.keyfile)
+
+
+def _unlock_paths(
+    paths: List[str],
+    passwords: List[str],
+    keyfiles: Optional[List[str]],
+    use_processes: Optional[bool] = None,
+) -> List:
+    keyfiles = (keyfiles or []) + [None] * len(paths)
+    requests = []
+    for path, password, keyfile in zip(paths, passwords, keyfiles):
+        with open(path, "rb") as f:
+            requests.append(
+                UnlockRequest(path, f.read(), password, _read_optional(keyfile))
+            )
+    return unlock_databases(requests, use_processes=use_processes)
+
+
+def _diff(kp1, kp2):
+    index1 = index_database(kp1)
+    index2 = index_database(kp2)
+    differences = compare_databases(
+        index1.as_sets(),
+        index2.as_sets(),
+        snapshot_database(kp1),
+        snapshot_database(kp2),
+    )
+    return differences, index1, index2
+
+
+def _apply_policy(policy: str, differences: Dict, kp1, kp2, index1, index2):
+    for entry_path in merge_entries(
+        kp2, kp1, differences["entries_only_in_db2"], index2, index1, save=False
+    ):
+        yield {"event": "merged", "path": entry_path}
+
+    if policy == "newest":
+        for entry_path in differences["changed_entries"]:
+            source = index2.entries[entry_path]
+            target = index1.entries[entry_path]
+            if source.mtime and target.mtime and source.mtime > target.mtime:
+                update_entry(source, target)
+                yield {"event": "updated", "path": entry_path}
+
+
+def _diff_many(results: List) -> int:
+    comparison = compare_many(
+        [snapshot_database(result.kp) for result in results],
+        [result.name for result in results],
+    )
+    for entry in comparison["entries"]:
+        if entry["missing_from"] or len(entry["versions"]) > 1:
+            _emit({"event": "entry", **entry})
+    _emit({"event": "summary", **comparison["summary"]})
+
+    summary = comparison["summary"]
+    return 1 if summary["identical"] != summary["entries"] else 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="kpd", description="Diff and merge KeePass databases"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for command in COMMANDS:
+        sub = subparsers.add_parser(command)
+        if command == "diff":
+            # More than two databases are compared in one N-way pass
+            sub.add_argument("databases", nargs="+", metavar="DATABASE")
+        elif command == "watch":
+            sub.add_argument("directory", help="folder with the synced copies")
+        elif command == "batch":
+            sub.add_argument(
+                "manifest",
+                help="JSON lines file, one pair of databases to diff per line",
+            )
+        else:
+            sub.add_argument("databases", nargs=2, metavar="DATABASE")
+        sub.add_argument(
+            "--password-env",
+            action="append",
+            metavar="VAR",
+            help="environment variable holding a password, once per database "
+            "(default: KPD_PASSWORD for all)",
+        )
+        sub.add_argument(
+            "--password-stdin",
+            action="store_true",
+            help="read one password per line from stdin",
+        )
+        sub.add_argument(
+            "--keyfile", action="append", metavar="FILE", help="once per database"
+        )
+        sub.add_argument(
+            "--profile",
+            action="store_true",
+            help="emit time and memory per stage as a final profile event",
+        )
+
+        if command == "watch":
+            sub.add_argument(
+                "--interval",
+                type=float,
+                default=2.0,
+                help="seconds between scans (default: 2)",
+            )
+            sub.add_argument(
+                "--summary",
+                action="store_true",
+                help="only emit the summary of each scan with changes",
+            )
+            sub.add_argument("--once", action="store_true", help="scan once and exit")
+
+        if command == "batch":
+            sub.add_argument(
+                "--workers",
+                type=int,
+                default=os.cpu_count() or 1,
+                help="pairs diffed at the same time (default: one per CPU)",
+            )
+            sub.add_argument(
+                "--timeout",
+                type=float,
+                help="seconds a pair may take before it is stopped",
+            )
+            sub.add_argument(
+                "--details",
+                action="store_true",
+                help="also emit the diff events of every pair",
+            )
+
+        if command == "merge":
+            sub.add_argument(
+                "-o",
+                "--output",
+                required=True,
+                help="where to write the merged database, based on the first one",
+            )
+            sub.add_argument(
+                "--policy",
+                choices=POLICIES,
+                default="union",
+                help="union adds entries only in the second database, newest "
+                "also takes changed entries from whichever side is newer",
+            )
+            sub.add_argument(
+                "--base",
+                metavar="DATABASE",
+                help="common ancestor of both databases for a three-way merge, "
+                "replaces --policy",
+            )
+
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    if not args.profile:
+        return _run(args)
+
+    profiler = Profiler()
+    with profiler.activate():
+        code = _run(args)
+    _emit({"event": "profile", "spans": profiler.summary()})
+    return code
+
+
+def _watch(args) -> int:
+    # Every copy is a version of the same vault, so one password serves all
+    password = read_passwords(1, args.password_env, args.password_stdin)[0]
+    keyfile = _read_optional((args.keyfile or [None])[0])
+    watcher = VaultWatcher(args.directory, password, keyfile)
+    try:
+        while True:
+            for event in watcher.scan():
+                if event["event"] == "error":
+                    _emit(event, sys.stderr)
+                elif not args.summary or event["event"] == "summary":
+                    _emit(event)
+            if args.once:
+                return 0
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        return 0
+
+
+def _merge_three_way(args, results: List) -> int:
+    base_kp, kp1, kp2 = results[2].kp, results[0].kp, results[1].kp
+    plan = merge_three_way(base_kp, kp1, kp2, save=False)
+    for left_path, right_path, fields in plan["updated"]:
+        _emit(
+            {"event": "updated", "path": left_path, "to": right_path, "fields": fields}
+        )
+    for entry_path in plan["added"]:
+        _emit({"event": "merged", "path": entry_path})
+    for entry_path in plan["deleted"]:
+        _emit({"event": "deleted", "path": entry_path})
+    for conflict in plan["conflicts"]:
+        _emit({"event": "conflict", **conflict})
+
+    # All changes are written with one save
+    save_database(kp1, args.output, results[0].transformed_key)
+    _emit({"event": "saved", "path": args.output})
+    _emit({"event": "summary", **{key: len(plan[key]) for key in plan}})
+    # Conflicts kept the first database's values and need a look
+    return 1 if plan["conflicts"] else 0
+
+
+def _changes(summary: Dict) -> int:
+    return sum(
+        value
+        for key, value in summary.items()
+        if key not in ("event", "identical_entries")
+    )
+
+
+def _job_passwords(job: Dict) -> List[str]:
+    if job.get("passwords"):
+        return (job["passwords"] * 2)[:2]
+    if job.get("password_file"):
+        values = []
+        for path in job["password_file"]:
+            with open(path) as f:
+                values.append(f.readline().rstrip("\r\n"))
+        return (values + [values[-1]] * 2)[:2]
+    return read_passwords(2, job.get("password_env"))
+
+
+def batch_job(job: Dict) -> Dict:
+    # Runs in a worker process of kpd batch, so it returns plain data only
+    started = time.perf_counter()
+    # The pairs already run in parallel processes, which cannot start more
+    results = _unlock_paths(
+        job["databases"], _job_passwords(job), job.get("keyfile"), use_processes=False
+    )
+    for result in results:
+        if result.error is not None:
+            raise ValueError(f"{result.name}: {result.error}")
+    differences, _, _ = _diff(results[0].kp, results[1].kp)
+    summary = _summary(differences)
+    del summary["event"]
+    return {
+        "summary": summary,
+        "events": list(diff_events(differences)) if job.get("details") else [],
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def _batch(args) -> int:
+    # Credentials given on the command line serve the jobs without their own
+    defaults = {"details": args.details}
+    if args.keyfile:
+        defaults["keyfile"] = args.keyfile
+    passwords = {}
+    if args.password_stdin:
+        passwords["passwords"] = read_passwords(2, None, True)
+    elif args.password_env:
+        passwords["password_env"] = args.password_env
+    jobs = []
+    for job in read_manifest(args.manifest):
+        if job.get("password_file") or job.get("password_env"):
+            jobs.append({**defaults, **job})
+        else:
+            jobs.append({**defaults, **passwords, **job})
+
+    totals: Dict[str, int] = {}
+    counts = {"identical": 0, "differing": 0, "failed": 0, "timed_out": 0}
+    for job, status, result in run_jobs(
+        batch_job, jobs, max(1, args.workers), args.timeout
+    ):
+        if status == "timeout":
+            counts["timed_out"] += 1
+            _emit({"event": "timeout", "job": job["name"]}, sys.stderr)
+            continue
+        if status == "error":
+            counts["failed"] += 1
+            _emit({"event": "error", "job": job["name"], "error": result}, sys.stderr)
+            continue
+
+        for event in result["events"]:
+            _emit({**event, "job": job["name"]})
+        summary = result["summary"]
+        for key, value in summary.items():
+            totals[key] = totals.get(key, 0) + value
+        differs = _changes(summary) > 0
+        counts["differing" if differs else "identical"] += 1
+        _emit(
+            {
+                "event": "result",
+                "job": job["name"],
+                "differs": differs,
+                "seconds": result["seconds"],
+                **summary,
+            }
+        )
+
+    _emit({"event": "summary", "jobs": len(jobs), **counts, "totals": totals})
+    if counts["failed"] or counts["timed_out"]:
+        return 2
+    return 1 if counts["differing"] else 0
+
+
+def _run(args) -> int:
+    try:
+        if args.command == "watch":
+            return _watch(args)
+        if args.command == "batch":
+            return _batch(args)
+        results = _unlock(args)
+    except (OSError, ValueError) as e:
+        _emit({"event": "error", "error": str(e)}, sys.stderr)
+        return 2
+
+    failed = False
+    for result in results:
+        if result.error is not None:
+            _emit(
+                {"event": "error", "database": result.name, "error": str(result.error)},
+                sys.stderr,
+            )
+            failed = True
+    if failed:
+        return 2
+
+    if args.command == "merge" and args.base:
+        return _merge_three_way(args, results)
+    if len(results) != 2:
+        return _diff_many(results)
+
+    kp1, kp2 = results[0].kp, results[1].kp
+    differences, index1, index2 = _diff(kp1, kp2)
+    for event in diff_events(differences):
+        _emit(event)
+
+    if args.command == "merge":
+        for event in _apply_policy(args.policy, differences, kp1, kp2, index1, index2):
+            _emit(event)
+        # Saved with the key derived at unlock, no second KDF run
+        save_database(kp1, args.output, results[0].transformed_key)
+        _emit({"event": "saved", "path": args.output})
+
+    summary = _summary(differences)
+    _emit(summary)
+    if args.command == "merge":
+        return 0
+
+    # Like diff(1): 0 when identical, 1 when there are differences
+    return 1 if _changes(summary) else 0
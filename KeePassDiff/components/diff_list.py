@@ -0,0 +1,48 @@
+from typing import Callable
+
+import streamlit as st
+
+from KeePassDiff.utils.listing import PathListing, page_slice
+
+ALL_GROUPS = "All groups"
+
+
+def show_diff_list(
+    listing: PathListing,
+    render_item: Callable[[str], None],
+    key: str,
+    page_size: int = 50,
+):
+    # The listing is built by the caller, once per diff rather than per run
+    if not listing.paths:
+        st.write("None")
+        return
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        prefix = st.text_input("Path starts with", key=f"{key}_prefix")
+    with col2:
+        title = st.text_input("Title contains", key=f"{key}_title")
+    with col3:
+        group = st.selectbox(
+            "Group",
+            [ALL_GROUPS] + listing.groups,
+            format_func=lambda g: g or "(root)",
+            key=f"{key}_group",
+        )
+
+    matches = listing.filter(prefix, title, None if group == ALL_GROUPS else group)
+
+    # Only the visible page creates widgets, however long the list is
+    page_key = f"{key}_page"
+    visible, pages = page_slice(matches, st.session_state.get(page_key, 1), page_size)
+    st.session_state[page_key] = min(st.session_state.get(page_key, 1), pages)
+
+    st.caption(
+        f"{len(matches)} of {len(listing.paths)} items, page {st.session_state[page_key]} of {pages}"
+    )
+    for path in visible:
+        render_item(path)
+
+    if pages > 1:
+        st.number_input("Page", min_value=1, max_value=pages, key=page_key)
@@ -20,6 +20,9 @@ def show_entry_details(entry_details: Optional[Dict] = None, key: str = None):
         )
         st.markdown(f"**Created:** {entry_details['created']}")
         st.markdown(f"**Modified:** {entry_details['modified']}")
+        if entry_details["attachments"]:
+            st.markdown(f"**Attachments:** {', '.join(entry_details['attachments'])}")
+        st.markdown(f"**History:** {entry_details['history']} revisions")
         st.markdown(f"**Path:** {entry_details['path']}")
     else:
         st.warning("Entry details not found")
@@ -0,0 +1,29 @@
+import streamlit as st
+
+from KeePassDiff.utils.profiling import Profiler
+
+
+def show_profile(profiler: Profiler):
+    st.sidebar.subheader("Profile")
+    rows = profiler.summary()
+    if not rows:
+        st.sidebar.write("Nothing measured in this run")
+        return
+
+    st.sidebar.dataframe(
+        [
+            {
+                "stage": row["name"],
+                "calls": row["count"],
+                "wall ms": round(row["wall_seconds"] * 1000, 1),
+                "cpu ms": round(row["cpu_seconds"] * 1000, 1),
+                "peak KiB": (
+                    round(row["peak_bytes"] / 1024, 1)
+                    if row["peak_bytes"] is not None
+                    else None
+                ),
+            }
+            for row in rows
+        ],
+        hide_index=True,
+    )
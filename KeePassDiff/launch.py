@@ -1,9 +1,18 @@
 import os
 import sys
-from streamlit.web import cli
+
+from KeePassDiff.cli import COMMANDS
 
 
 def launch():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        # Headless mode never imports Streamlit
+        from KeePassDiff.cli import main
+
+        sys.exit(main(sys.argv[1:]))
+
+    from streamlit.web import cli
+
     path = os.path.dirname(os.path.abspath(__file__))
 
     sys.argv = ["streamlit", "run", f"{os.path.join(path, "app.py")}"]
@@ -0,0 +1,113 @@
+import json
+import os
+import time
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# Job keys holding paths, resolved against the manifest's directory
+PATH_KEYS = ("databases", "keyfile", "password_file")
+
+
+def _as_list(value) -> List:
+    return value if isinstance(value, list) else [value]
+
+
+def read_manifest(path: str) -> List[Dict]:
+    # One job per line as a JSON object: "databases" with the two paths, and
+    # optionally "name", "password_env", "password_file", "keyfile" (one per
+    # database, or one for both) and "timeout" in seconds
+    base = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{path}:{number}: {e}") from e
+            if not isinstance(job, dict) or len(job.get("databases") or ()) != 2:
+                raise ValueError(f"{path}:{number}: a job needs two databases")
+            for key in PATH_KEYS:
+                if job.get(key):
+                    job[key] = [
+                        os.path.join(base, p) if p else None for p in _as_list(job[key])
+                    ]
+            if job.get("password_env"):
+                job["password_env"] = _as_list(job["password_env"])
+            job["name"] = str(job.get("name", number))
+            jobs.append(job)
+    return jobs
+
+
+def _run_job(worker: Callable[[Dict], Dict], job: Dict, connection):
+    try:
+        outcome = ("ok", worker(job))
+    except Exception as e:
+        outcome = ("error", str(e) or type(e).__name__)
+    connection.send(outcome)
+    connection.close()
+
+
+def run_jobs(
+    worker: Callable[[Dict], Dict],
+    jobs: List[Dict],
+    workers: int,
+    timeout: Optional[float] = None,
+) -> Iterator[Tuple[Dict, str, object]]:
+    # Runs worker(job) in a process of its own, at most `workers` at a time,
+    # and yields (job, status, result) in the order jobs finish. status is
+    # "ok" with the worker's result, "error" with a message, or "timeout"
+    # once the job ran longer than its own or the default timeout. A process
+    # per job is what lets a stuck unlock be killed without losing the rest.
+    # The worker must be importable by name for the spawn start method.
+    context = get_context()
+    pending = list(reversed(jobs))
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                job = pending.pop()
+                reader, writer = context.Pipe(duplex=False)
+                process = context.Process(
+                    target=_run_job, args=(worker, job, writer), daemon=True
+                )
+                process.start()
+                # Only the child holds the writer, so its exit ends the pipe
+                writer.close()
+                limit = job.get("timeout", timeout)
+                deadline = None if limit is None else time.monotonic() + limit
+                running[reader] = (job, process, deadline)
+
+            deadlines = [d for _, _, d in running.values() if d is not None]
+            wait_for = (
+                max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            )
+            for reader in wait(list(running), wait_for):
+                job, process, _ = running.pop(reader)
+                try:
+                    status, result = reader.recv()
+                except EOFError:
+                    process.join()
+                    status = "error"
+                    result = f"worker exited with code {process.exitcode}"
+                reader.close()
+                process.join()
+                yield job, status, result
+
+            now = time.monotonic()
+            for reader, (job, process, deadline) in list(running.items()):
+                if deadline is not None and now >= deadline:
+                    del running[reader]
+                    process.terminate()
+                    process.join()
+                    reader.close()
+                    yield job, "timeout", None
+    finally:
+        # Left early, by an interrupt for instance
+        for reader, (_, process, _) in running.items():
+            process.terminate()
+            process.join()
+            reader.close()
@@ -1,14 +1,391 @@
-from typing import Dict, Set
+from bisect import bisect_left, insort
+from difflib import SequenceMatcher
+from typing import Dict, List, Optional, Set, Tuple
 
+from KeePassDiff.utils.profiling import profiled
+from KeePassDiff.utils.snapshot import (
+    EMPTY_FIELD,
+    EntrySnapshot,
+    GroupNode,
+    changed_fields,
+    group_tree,
+)
 
+
+@profiled("compare_databases")
 def compare_databases(
-    db1_data: Dict[str, Set[str]], db2_data: Dict[str, Set[str]]
-) -> Dict:
-    return {
+    db1_data: Dict[str, Set[str]],
+    db2_data: Dict[str, Set[str]],
+    db1_snapshots: Optional[Dict[str, EntrySnapshot]] = None,
+    db2_snapshots: Optional[Dict[str, EntrySnapshot]] = None,
+) -> "DiffResult":
+    differences = {
         "entries_only_in_db1": sorted(db1_data["entries"] - db2_data["entries"]),
         "entries_only_in_db2": sorted(db2_data["entries"] - db1_data["entries"]),
         "common_entries": sorted(db1_data["entries"] & db2_data["entries"]),
         "groups_only_in_db1": sorted(db1_data["groups"] - db2_data["groups"]),
-        "groups_only_in_db2": sorted(db2_data["groups"] - db2_data["groups"]),
+        "groups_only_in_db2": sorted(db2_data["groups"] - db1_data["groups"]),
         "common_groups": sorted(db1_data["groups"] & db2_data["groups"]),
     }
+    if db1_snapshots is not None and db2_snapshots is not None:
+        differences.update(compare_contents(differences, db1_snapshots, db2_snapshots))
+    return DiffResult(differences, db1_snapshots, db2_snapshots)
+
+
+def _contains_sorted(items: List[str], item: str) -> bool:
+    i = bisect_left(items, item)
+    return i < len(items) and items[i] == item
+
+
+def _remove_sorted(items: List[str], item: str) -> bool:
+    i = bisect_left(items, item)
+    if i < len(items) and items[i] == item:
+        del items[i]
+        return True
+    return False
+
+
+# The result of compare_databases. It reads like the plain dict it used to be,
+# and keeps its sorted lists current when entries are merged, so a merge costs a
+# few bisections instead of walking and comparing both databases again.
+class DiffResult(dict):
+    def __init__(
+        self,
+        differences: Dict,
+        db1_snapshots: Optional[Dict[str, EntrySnapshot]] = None,
+        db2_snapshots: Optional[Dict[str, EntrySnapshot]] = None,
+    ):
+        super().__init__(differences)
+        self.snapshots = {1: db1_snapshots, 2: db2_snapshots}
+
+    def __missing__(self, key):
+        # The group tree diff is only built when asked for, from the snapshots
+        if key != "group_tree" or None in self.snapshots.values():
+            raise KeyError(key)
+        self[key] = compare_group_trees(
+            group_tree(
+                self["groups_only_in_db1"] + self["common_groups"], self.snapshots[1]
+            ),
+            group_tree(
+                self["groups_only_in_db2"] + self["common_groups"], self.snapshots[2]
+            ),
+        )
+        return self[key]
+
+    def apply_merge(
+        self,
+        entry_path: str,
+        source: int,
+        target_snapshot: Optional[EntrySnapshot] = None,
+    ) -> bool:
+        # source is the database the entry was copied from, 1 or 2
+        target = 3 - source
+        if not _remove_sorted(self[f"entries_only_in_db{source}"], entry_path):
+            return False
+        self.pop("group_tree", None)
+        if "similar_entries" in self:
+            # The merged entry is no longer exclusive to pair up
+            self["similar_entries"] = [
+                pair
+                for pair in self["similar_entries"]
+                if pair[source - 1] != entry_path
+            ]
+        insort(self["common_entries"], entry_path)
+
+        self._merge_groups(entry_path.split("/")[:-1], source)
+
+        snapshots = self.snapshots[target]
+        if snapshots is None or target_snapshot is None:
+            return True
+        snapshots[entry_path] = target_snapshot
+        fields = changed_fields(self.snapshots[source][entry_path], target_snapshot)
+        if fields:
+            insort(self["changed_entries"], entry_path)
+            self["field_deltas"][entry_path] = fields
+        else:
+            insort(self["identical_entries"], entry_path)
+        return True
+
+    def apply_group_merge(
+        self,
+        group_path: str,
+        source: int,
+        target_snapshots: Dict[str, EntrySnapshot],
+    ) -> bool:
+        # target_snapshots holds the entries merge_group copied. False means
+        # some copied entry was not listed as exclusive, a moved one for
+        # instance, and the diff has to be compared again to be right.
+        self.pop("group_tree", None)
+        self._merge_groups(group_path.split("/")[:-1], source)
+        only_in_source = self[f"groups_only_in_db{source}"]
+        start = bisect_left(only_in_source, group_path + "/")
+        end = bisect_left(only_in_source, group_path + "/\U0010ffff", start)
+        subgroups = only_in_source[start:end]
+        del only_in_source[start:end]
+        if _remove_sorted(only_in_source, group_path):
+            subgroups.append(group_path)
+        for path in subgroups:
+            insort(self["common_groups"], path)
+
+        applied = [
+            self.apply_merge(entry_path, source, snapshot)
+            for entry_path, snapshot in target_snapshots.items()
+        ]
+        return all(applied)
+
+    def _merge_groups(self, parts: List[str], source: int):
+        # Groups a merge created on the target side are common now
+        target = 3 - source
+        for depth in range(1, len(parts) + 1):
+            group_path = "/".join(parts[:depth])
+            if _remove_sorted(self[f"groups_only_in_db{source}"], group_path):
+                insort(self["common_groups"], group_path)
+            elif not _contains_sorted(self["common_groups"], group_path):
+                # Created from a group name with a slash in the source
+                only_in_target = self[f"groups_only_in_db{target}"]
+                if not _contains_sorted(only_in_target, group_path):
+                    insort(only_in_target, group_path)
+
+
+def compare_contents(
+    differences: Dict,
+    db1_snapshots: Dict[str, EntrySnapshot],
+    db2_snapshots: Dict[str, EntrySnapshot],
+) -> Dict:
+    identical, changed, field_deltas = [], [], {}
+    for entry_path in differences["common_entries"]:
+        fields = changed_fields(db1_snapshots[entry_path], db2_snapshots[entry_path])
+        if fields:
+            changed.append(entry_path)
+            field_deltas[entry_path] = fields
+        else:
+            identical.append(entry_path)
+
+    # An exclusive entry whose UUID is exclusive on the other side too was moved
+    # or renamed rather than deleted and added again
+    db2_exclusive_by_uuid = {
+        db2_snapshots[entry_path].uuid: entry_path
+        for entry_path in differences["entries_only_in_db2"]
+        if db2_snapshots[entry_path].uuid is not None
+    }
+    moved = []
+    for entry_path in differences["entries_only_in_db1"]:
+        uuid = db1_snapshots[entry_path].uuid
+        if uuid is not None and uuid in db2_exclusive_by_uuid:
+            new_path = db2_exclusive_by_uuid[uuid]
+            moved.append((entry_path, new_path))
+            field_deltas[entry_path] = changed_fields(
+                db1_snapshots[entry_path], db2_snapshots[new_path]
+            )
+
+    moved_from = {old for old, _ in moved}
+    moved_to = {new for _, new in moved}
+    only_in_db1 = [p for p in differences["entries_only_in_db1"] if p not in moved_from]
+    only_in_db2 = [p for p in differences["entries_only_in_db2"] if p not in moved_to]
+    return {
+        "entries_only_in_db1": only_in_db1,
+        "entries_only_in_db2": only_in_db2,
+        "identical_entries": identical,
+        "changed_entries": changed,
+        "moved_entries": moved,
+        "field_deltas": field_deltas,
+        # Without a shared UUID a move is only likely, these stay exclusive
+        "similar_entries": find_similar_entries(
+            [db1_snapshots[p] for p in only_in_db1],
+            [db2_snapshots[p] for p in only_in_db2],
+        ),
+    }
+
+
+def _blocking_keys(snapshot: EntrySnapshot) -> List[Tuple[str, bytes]]:
+    keys = [("host", snapshot.url_host)] if snapshot.url_host else []
+    for field in ("username", "password"):
+        value = snapshot.fields.get(field)
+        if value and value != EMPTY_FIELD:
+            keys.append((field, value))
+    return keys
+
+
+def similarity(first: EntrySnapshot, second: EntrySnapshot) -> float:
+    # Share of equal fields, with the title as one more field scored by how
+    # alike the two titles read. Fields empty on both sides do not count.
+    equal = counted = 0
+    for name in first.fields.keys() | second.fields.keys():
+        if name in ("mtime", "history"):
+            continue
+        value = first.fields.get(name, EMPTY_FIELD)
+        other = second.fields.get(name, EMPTY_FIELD)
+        if value == EMPTY_FIELD and other == EMPTY_FIELD:
+            continue
+        counted += 1
+        equal += value == other
+    title = SequenceMatcher(
+        None, (first.title or "").casefold(), (second.title or "").casefold()
+    ).ratio()
+    return (equal + title) / (counted + 1)
+
+
+@profiled("find_similar_entries")
+def find_similar_entries(
+    db1_entries: List[EntrySnapshot],
+    db2_entries: List[EntrySnapshot],
+    min_score: float = 0.6,
+    max_block: int = 50,
+) -> List[Tuple[str, str, float]]:
+    # Entries of the second database are blocked by URL host, username and
+    # password digest, and an entry is only scored against those sharing a
+    # block with it. Blocks larger than max_block, like a username used
+    # everywhere, say little and would make this quadratic, so they are
+    # skipped. Each entry is paired at most once, best scores first.
+    if not db1_entries or not db2_entries:
+        return []
+    blocks: Dict[Tuple[str, bytes], List[int]] = {}
+    for j, snapshot in enumerate(db2_entries):
+        for key in _blocking_keys(snapshot):
+            blocks.setdefault(key, []).append(j)
+
+    scored = []
+    for i, snapshot in enumerate(db1_entries):
+        candidates = set()
+        for key in _blocking_keys(snapshot):
+            block = blocks.get(key, ())
+            if len(block) <= max_block:
+                candidates.update(block)
+        for j in candidates:
+            score = similarity(snapshot, db2_entries[j])
+            if score >= min_score:
+                scored.append((score, i, j))
+
+    paired1, paired2, similar = set(), set(), []
+    for score, i, j in sorted(scored, key=lambda s: (-s[0], s[1], s[2])):
+        if i not in paired1 and j not in paired2:
+            paired1.add(i)
+            paired2.add(j)
+            similar.append((db1_entries[i].path, db2_entries[j].path, round(score, 3)))
+    return similar
+
+
+@profiled("compare_group_trees")
+def compare_group_trees(tree1: GroupNode, tree2: GroupNode) -> Dict:
+    # Descends only where the digests differ, an identical subtree costs one
+    # comparison however large it is
+    changed, removed, added = [], [], []
+    identical = 0
+    stack = [(tree1, tree2)]
+    while stack:
+        node1, node2 = stack.pop()
+        if node1.digest == node2.digest:
+            identical += 1
+            continue
+        changed.append(node1.path)
+        for name, child1 in node1.children.items():
+            child2 = node2.children.get(name)
+            if child2 is None:
+                removed.append(child1)
+            else:
+                stack.append((child1, child2))
+        added.extend(
+            child2
+            for name, child2 in node2.children.items()
+            if name not in node1.children
+        )
+
+    # A removed subtree with the same content as an added one was moved or
+    # renamed. Empty subtrees all look alike, so they are never paired.
+    added_by_digest: Dict[bytes, List[GroupNode]] = {}
+    for node in added:
+        if node.entries:
+            added_by_digest.setdefault(node.digest, []).append(node)
+    moved = []
+    for node in removed:
+        candidates = added_by_digest.get(node.digest)
+        if node.entries and candidates:
+            moved.append((node.path, candidates.pop(0).path))
+
+    moved_from = {old for old, _ in moved}
+    moved_to = {new for _, new in moved}
+    return {
+        "groups_removed": sorted(n.path for n in removed if n.path not in moved_from),
+        "groups_added": sorted(n.path for n in added if n.path not in moved_to),
+        "groups_moved": sorted(moved),
+        "groups_changed": sorted(changed),
+        "identical_subtrees": identical,
+    }
+
+
+@profiled("compare_many")
+def compare_many(
+    databases: List[Dict[str, EntrySnapshot]], names: Optional[List[str]] = None
+) -> Dict:
+    names = names or [f"db{i + 1}" for i in range(len(databases))]
+
+    # Entries are matched by UUID first so moved copies line up, then rows
+    # still missing databases are joined by path like compare_databases does.
+    # A row never takes two copies from one database.
+    combined: Dict[int, List] = {}
+    seen_in: Dict[int, Set[int]] = {}
+    key_by_uuid: Dict = {}
+    for i, snapshots in enumerate(databases):
+        for snapshot in snapshots.values():
+            key = key_by_uuid.get(snapshot.uuid)
+            if key is None or i in seen_in[key]:
+                key = len(combined)
+                combined[key] = []
+                seen_in[key] = set()
+                if snapshot.uuid is not None:
+                    key_by_uuid.setdefault(snapshot.uuid, key)
+            combined[key].append((i, snapshot))
+            seen_in[key].add(i)
+
+    key_by_path: Dict[str, int] = {}
+    for key in list(combined):
+        path = combined[key][0][1].path
+        target = key_by_path.setdefault(path, key)
+        if target != key and not seen_in[target] & seen_in[key]:
+            combined[target] = sorted(
+                combined[target] + combined.pop(key), key=lambda copy: copy[0]
+            )
+            seen_in[target] |= seen_in.pop(key)
+
+    entries = []
+    for copies in combined.values():
+        present = {i for i, _ in copies}
+        versions: Dict[bytes, List[int]] = {}
+        for i, snapshot in copies:
+            versions.setdefault(snapshot.fingerprint, []).append(i)
+
+        first = copies[0][1]
+        fields = set()
+        for _, snapshot in copies[1:]:
+            fields.update(changed_fields(first, snapshot))
+        paths = {names[i]: snapshot.path for i, snapshot in copies}
+
+        entries.append(
+            {
+                "path": first.path,
+                "paths": paths,
+                "present_in": [names[i] for i in sorted(present)],
+                "missing_from": [
+                    names[i] for i in range(len(databases)) if i not in present
+                ],
+                "versions": [[names[i] for i in group] for group in versions.values()],
+                "fields": sorted(fields),
+                "moved": len(set(paths.values())) > 1,
+            }
+        )
+
+    entries.sort(key=lambda entry: entry["path"])
+    return {
+        "databases": names,
+        "entries": entries,
+        "summary": {
+            "entries": len(entries),
+            "in_all": sum(1 for entry in entries if not entry["missing_from"]),
+            "identical": sum(
+                1
+                for entry in entries
+                if not entry["missing_from"] and len(entry["versions"]) == 1
+            ),
+            "diverged": sum(1 for entry in entries if len(entry["versions"]) > 1),
+        },
+    }
@@ -1,36 +1,46 @@
+import base64
+import hashlib
+import io
+import sys
 import tempfile
-from typing import Dict, Optional, Set, Tuple
+import time
+import weakref
+import zlib
+from copy import deepcopy
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+from uuid import UUID, uuid4
 
+from construct import Container
+from lxml import etree
 from pykeepass import PyKeePass
+from pykeepass.entry import Entry
+from pykeepass.group import Group
 
+from KeePassDiff.utils.profiling import profiled
 
-def save_temp_database(db_file, keyfile=None) -> Tuple[str, Optional[str]]:
-    # Handle if db_file is a file-like object or a file path
-    if hasattr(db_file, "getvalue"):
-        db_bytes = db_file.getvalue()
-    elif hasattr(db_file, "read"):
-        db_bytes = db_file.read()
-    elif isinstance(db_file, (str, bytes)):
+
+def read_file_bytes(file, name: str) -> bytes:
+    # Handle if file is a file-like object or a file path
+    if hasattr(file, "getvalue"):
+        return file.getvalue()
+    elif hasattr(file, "read"):
+        return file.read()
+    elif isinstance(file, (str, bytes)):
         # Assume it's a file path
-        with open(db_file, "rb") as f:
-            db_bytes = f.read()
-    else:
-        raise ValueError("db_file must be a file-like object or a file path")
+        with open(file, "rb") as f:
+            return f.read()
+    raise ValueError(f"{name} must be a file-like object or a file path")
+
+
+def save_temp_database(db_file, keyfile=None) -> Tuple[str, Optional[str]]:
+    db_bytes = read_file_bytes(db_file, "db_file")
 
     with tempfile.NamedTemporaryFile(delete=False, suffix=".kdbx") as tmp:
         tmp.write(db_bytes)
         tmp_keyfile = None
 
         if keyfile:
-            if hasattr(keyfile, "getvalue"):
-                key_bytes = keyfile.getvalue()
-            elif hasattr(keyfile, "read"):
-                key_bytes = keyfile.read()
-            elif isinstance(keyfile, (str, bytes)):
-                with open(keyfile, "rb") as f:
-                    key_bytes = f.read()
-            else:
-                raise ValueError("keyfile must be a file-like object or a file path")
+            key_bytes = read_file_bytes(keyfile, "keyfile")
             with tempfile.NamedTemporaryFile(delete=False) as ktmp:
                 ktmp.write(key_bytes)
                 tmp_keyfile = ktmp.name
@@ -38,76 +48,583 @@ def save_temp_database(db_file, keyfile=None) -> Tuple[str, Optional[str]]:
         return tmp.name, tmp_keyfile
 
 
+def open_database_bytes(
+    db_bytes: bytes,
+    password: Optional[str] = None,
+    keyfile_bytes: Optional[bytes] = None,
+    transformed_key: Optional[bytes] = None,
+) -> PyKeePass:
+    # A BytesIO over bytes shares them until it is written to, so opening an
+    # upload's getvalue() does not copy it. The database keeps this stream,
+    # saves without a filename rewrite it.
+    return PyKeePass(
+        io.BytesIO(db_bytes),
+        password=password,
+        keyfile=io.BytesIO(keyfile_bytes) if keyfile_bytes else None,
+        transformed_key=transformed_key,
+    )
+
+
+@profiled("save")
+def export_database(kp: PyKeePass, transformed_key: Optional[bytes] = None) -> bytes:
+    # With the key the database was opened with, no KDF runs and the KDF salt
+    # is kept, so the key stays valid for the result
+    buffer = io.BytesIO()
+    kp.save(buffer, transformed_key=transformed_key)
+    return buffer.getvalue()
+
+
+def database_digest(
+    db_bytes, password: Optional[str] = None, keyfile_bytes=None
+) -> str:
+    # Each part is hashed separately so that no concatenation of parts collides
+    digest = hashlib.sha256()
+    for part in (db_bytes, keyfile_bytes or b"", (password or "").encode()):
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+
+def _wipe_keys(keys: Dict[str, Tuple[str, bytearray]], slot: Optional[str] = None):
+    for name in list(keys) if slot is None else [slot]:
+        held = keys.pop(name, None)
+        if held is not None:
+            held[1][:] = bytes(len(held[1]))
+
+
+# Unlocked databases of one session, one per upload slot. A rerun with the same
+# upload and credentials gets the already opened database back and skips the KDF.
+# The transformed key of each slot is kept too, so a new upload with the same
+# credentials, and every save and export, skips the KDF as well. Slots unused
+# for idle_timeout seconds are dropped with their keys.
+class DatabaseCache:
+    def __init__(
+        self,
+        idle_timeout: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.idle_timeout = idle_timeout
+        self._clock = clock
+        self._slots: Dict[str, Tuple[str, PyKeePass]] = {}
+        # slot -> (kdf digest, transformed key). A bytearray so that it can be
+        # zeroed, pykeepass holds its own copy while the database is open.
+        self._keys: Dict[str, Tuple[str, bytearray]] = {}
+        self._used: Dict[str, float] = {}
+        # Keys are wiped with the cache when the session ends
+        weakref.finalize(self, _wipe_keys, self._keys)
+
+    def get(self, slot: str, digest: str) -> Optional[PyKeePass]:
+        self.expire()
+        cached = self._slots.get(slot)
+        if cached and cached[0] == digest:
+            self._used[slot] = self._clock()
+            return cached[1]
+        return None
+
+    def put(self, slot: str, digest: str, kp: PyKeePass):
+        self._slots[slot] = (digest, kp)
+        self._used[slot] = self._clock()
+
+    def get_key(self, slot: str, key_digest: Optional[str]) -> Optional[bytes]:
+        self.expire()
+        held = self._keys.get(slot)
+        if held is None:
+            return None
+        if key_digest is None or held[0] != key_digest:
+            # Credentials or KDF parameters changed
+            _wipe_keys(self._keys, slot)
+            return None
+        self._used[slot] = self._clock()
+        return bytes(held[1])
+
+    def put_key(
+        self, slot: str, key_digest: Optional[str], transformed_key: Optional[bytes]
+    ):
+        _wipe_keys(self._keys, slot)
+        if key_digest is not None and transformed_key is not None:
+            self._keys[slot] = (key_digest, bytearray(transformed_key))
+            self._used[slot] = self._clock()
+
+    def touch(self, *slots: str) -> bool:
+        # Marks the slots as used without opening anything. False when one of
+        # them is gone or idle, expire() then evicts it.
+        now = self._clock()
+        for slot in slots:
+            used = self._used.get(slot)
+            if slot not in self._slots or used is None:
+                return False
+            if self.idle_timeout is not None and now - used > self.idle_timeout:
+                return False
+        for slot in slots:
+            self._used[slot] = now
+        return True
+
+    def expire(self) -> List[str]:
+        if self.idle_timeout is None:
+            return []
+        now = self._clock()
+        expired = [
+            slot for slot, used in self._used.items() if now - used > self.idle_timeout
+        ]
+        for slot in expired:
+            self.evict(slot)
+        return expired
+
+    def evict(self, slot: Optional[str] = None, keep_key: bool = False):
+        if slot is None:
+            self._slots.clear()
+        else:
+            self._slots.pop(slot, None)
+        if not keep_key:
+            _wipe_keys(self._keys, slot)
+            if slot is None:
+                self._used.clear()
+            else:
+                self._used.pop(slot, None)
+
+    def __contains__(self, slot: str) -> bool:
+        return slot in self._slots
+
+
+def _entry_path(entry) -> str:
+    # Ensure all elements are strings and not None
+    return "/".join(
+        [str(g) for g in entry.path[:-1] if g is not None]
+        + [str(entry.title) if entry.title is not None else ""]
+    )
+
+
+def _group_path(group) -> str:
+    return "/".join([str(g) for g in group.path if g is not None])
+
+
+# Lookup tables over one database, built in a single walk of its entries and
+# groups. Merges through `merge_entry` keep the index of the target up to date.
+class DatabaseIndex:
+    def __init__(self):
+        self.entries: Dict[str, Entry] = {}
+        self.entries_by_uuid: Dict[UUID, Entry] = {}
+        self.groups: Dict[str, Group] = {}
+
+    def add_entry(self, entry_path: str, entry: Entry):
+        # Keep the first entry of a path, like a scan over `kp.entries` would
+        self.entries.setdefault(entry_path, entry)
+        uuid = getattr(entry, "uuid", None)
+        if uuid is not None:
+            self.entries_by_uuid[uuid] = entry
+
+    def add_group(self, group_path: str, group: Group):
+        self.groups.setdefault(group_path, group)
+
+    def as_sets(self) -> Dict[str, Set[str]]:
+        return {"entries": set(self.entries), "groups": set(self.groups)}
+
+
+def element_text(element, tag: str) -> Optional[str]:
+    # A scan of the few children is cheaper than find() with its path parser
+    for child in element:
+        if child.tag == tag:
+            return child.text
+    return None
+
+
+def element_title(element) -> Optional[str]:
+    for child in element.iterchildren("String"):
+        if element_text(child, "Key") == "Title":
+            return element_text(child, "Value")
+    return None
+
+
+def walk_tree(kp: PyKeePass) -> Iterator[Tuple[Tuple[str, ...], object]]:
+    # One pass over the XML in document order, the order of kp.groups and
+    # kp.entries, without the XPath query per property that Entry and Group
+    # use. Groups come with their own path, entries with the path of their
+    # group, and all entries of a group share that one tuple. History is
+    # skipped. Unnamed groups are left out of paths like in Group.path.
+    return walk_group(kp.tree.getroot().find("Root/Group"))
+
+
+def walk_group(
+    group, group_path: Tuple[str, ...] = ()
+) -> Iterator[Tuple[Tuple[str, ...], object]]:
+    yield group_path, group
+    stack = [(group_path, group.iterchildren("Entry", "Group"))]
+    while stack:
+        group_path, children = stack[-1]
+        for child in children:
+            if child.tag == "Entry":
+                yield group_path, child
+                continue
+            name = element_text(child, "Name")
+            path = group_path if name is None else group_path + (sys.intern(name),)
+            yield path, child
+            stack.append((path, child.iterchildren("Entry", "Group")))
+            break
+        else:
+            stack.pop()
+
+
+def join_path(group_path: Tuple[str, ...], title: Optional[str]) -> str:
+    # Same key as _entry_path gives for an Entry
+    return "/".join(group_path + (title if title is not None else "",))
+
+
+@profiled("index_database")
+def index_database(kp: PyKeePass) -> DatabaseIndex:
+    index = DatabaseIndex()
+
+    # Anything without an XML tree is indexed through its properties
+    if getattr(kp, "tree", None) is None:
+        for entry in kp.entries:
+            index.add_entry(_entry_path(entry), entry)
+        for group in kp.groups:
+            index.add_group(_group_path(group), group)
+        return index
+
+    _index_elements(index, kp, walk_tree(kp))
+    return index
+
+
+def _index_elements(
+    index: DatabaseIndex, kp: PyKeePass, elements: Iterator
+) -> List[str]:
+    entry_paths = []
+    for group_path, element in elements:
+        if element.tag == "Entry":
+            entry_path = join_path(group_path, element_title(element))
+            index.add_entry(entry_path, Entry(element=element, kp=kp))
+            entry_paths.append(entry_path)
+        else:
+            index.add_group("/".join(group_path), Group(element=element, kp=kp))
+    return entry_paths
+
+
 def get_entries_set(kp: PyKeePass) -> Dict[str, Set[str]]:
-    entries = set()
-    groups = set()
+    return index_database(kp).as_sets()
+
+
+def _find_entry(
+    kp: PyKeePass, entry_path: str, index: Optional[DatabaseIndex] = None
+) -> Optional[Entry]:
+    if index is not None:
+        return index.entries.get(entry_path)
 
     for entry in kp.entries:
-        # Ensure all elements are strings and not None
-        entry_path = "/".join(
-            [str(g) for g in entry.path[:-1] if g is not None]
-            + [str(entry.title) if entry.title is not None else ""]
+        if _entry_path(entry) == entry_path:
+            return entry
+    return None
+
+
+def _resolve_group(
+    kp: PyKeePass, group_path: List[str], index: Optional[DatabaseIndex] = None
+) -> Group:
+    if index is None:
+        current_group = kp.root_group
+        for group_name in group_path:
+            next_group = next(
+                (g for g in current_group.subgroups if g.name == group_name), None
+            )
+            if not next_group:
+                next_group = kp.add_group(current_group, group_name)
+            current_group = next_group
+        return current_group
+
+    # Start from the deepest group that already exists and create the rest
+    depth = len(group_path)
+    while depth and "/".join(group_path[:depth]) not in index.groups:
+        depth -= 1
+    current_group = index.groups.get("/".join(group_path[:depth])) or kp.root_group
+    for i in range(depth, len(group_path)):
+        current_group = kp.add_group(current_group, group_path[i])
+        index.add_group("/".join(group_path[: i + 1]), current_group)
+    return current_group
+
+
+def get_entry_details(
+    kp: PyKeePass, entry_path: str, index: Optional[DatabaseIndex] = None
+) -> Dict:
+    entry = _find_entry(kp, entry_path, index)
+    if entry is None:
+        return None
+
+    return {
+        "title": entry.title,
+        "username": entry.username,
+        "password": entry.password,
+        "url": entry.url,
+        "notes": entry.notes,
+        "created": entry.ctime,
+        "modified": entry.mtime,
+        "path": "/".join(entry_path.split("/")[:-1]),
+        # Names only, the binaries are not decoded for the details
+        "attachments": [attachment.filename for attachment in entry.attachments],
+        "history": len(entry.history),
+    }
+
+
+def _copy_entries(
+    source_kp: PyKeePass,
+    target_kp: PyKeePass,
+    entry_paths: List[str],
+    source_index: Optional[DatabaseIndex],
+    target_index: Optional[DatabaseIndex],
+    preserve_uuids: bool,
+) -> List[str]:
+    # Copies the whole entry element with its times, custom strings,
+    # attachments and history, so a merged entry is identical to its source.
+    # UUIDs, binaries and icons are handled once for all entries.
+    found = []
+    for entry_path in entry_paths:
+        source_entry = _find_entry(source_kp, entry_path, source_index)
+        if source_entry is not None:
+            found.append((entry_path, deepcopy(source_entry._element)))
+    if not found:
+        return []
+
+    elements = [element for _, element in found]
+    # Before they are in the tree, where preserved UUIDs would count as taken
+    _assign_uuids(target_kp, *elements, preserve_uuids=preserve_uuids)
+    for entry_path, element in found:
+        group = _resolve_group(target_kp, entry_path.split("/")[:-1], target_index)
+        group._element.append(element)
+        if target_index is not None:
+            target_index.add_entry(entry_path, Entry(element=element, kp=target_kp))
+    _copy_binaries(source_kp, target_kp, *elements)
+    _copy_custom_icons(source_kp, target_kp, *elements)
+    return [entry_path for entry_path, _ in found]
+
+
+@profiled("merge_entry")
+def merge_entry(
+    source_kp: PyKeePass,
+    target_kp: PyKeePass,
+    entry_path: str,
+    source_index: Optional[DatabaseIndex] = None,
+    target_index: Optional[DatabaseIndex] = None,
+    preserve_uuids: bool = False,
+) -> bool:
+    return bool(
+        _copy_entries(
+            source_kp,
+            target_kp,
+            [entry_path],
+            source_index,
+            target_index,
+            preserve_uuids,
         )
-        entries.add(entry_path)
+    )
 
-    for group in kp.groups:
-        if group != "Root":
-            group_path = "/".join([str(g) for g in group.path if g is not None])
-            groups.add(group_path)
 
-    return {"entries": entries, "groups": groups}
+@profiled("save")
+def save_database(
+    kp: PyKeePass, filename=None, transformed_key: Optional[bytes] = None
+):
+    filename = filename or kp.filename
+    # An in-memory database is rewritten in place rather than appended to
+    if hasattr(filename, "write") and hasattr(filename, "truncate"):
+        filename.seek(0)
+        filename.truncate()
+    kp.save(filename, transformed_key=transformed_key)
 
 
-def get_entry_details(kp: PyKeePass, entry_path: str) -> Dict:
-    path_parts = entry_path.split("/")
-    title = path_parts[-1]
-    group_path = path_parts[:-1]
+@profiled("merge_entries")
+def merge_entries(
+    source_kp: PyKeePass,
+    target_kp: PyKeePass,
+    entry_paths: List[str],
+    source_index: Optional[DatabaseIndex] = None,
+    target_index: Optional[DatabaseIndex] = None,
+    save: bool = True,
+    preserve_uuids: bool = False,
+) -> List[str]:
+    # The target index doubles as the group cache, so each missing group is
+    # created once however many merged entries live in it
+    if source_index is None:
+        source_index = index_database(source_kp)
+    if target_index is None:
+        target_index = index_database(target_kp)
 
-    for entry in kp.entries:
-        if (
-            entry.title == title
-            and [str(g) for g in entry.path[:-1] if g is not None] == group_path
-        ):
-            return {
-                "title": entry.title,
-                "username": entry.username,
-                "password": entry.password,
-                "url": entry.url,
-                "notes": entry.notes,
-                "created": entry.ctime,
-                "modified": entry.mtime,
-                "path": "/".join(group_path),
-            }
+    merged = _copy_entries(
+        source_kp, target_kp, entry_paths, source_index, target_index, preserve_uuids
+    )
+    if merged and save:
+        save_database(target_kp)
+    return merged
+
+
+def _find_group(
+    kp: PyKeePass, group_path: str, index: Optional[DatabaseIndex] = None
+) -> Optional[Group]:
+    if index is not None:
+        return index.groups.get(group_path)
+
+    for group in kp.groups:
+        if _group_path(group) == group_path:
+            return group
     return None
 
 
-def merge_entry(source_kp: PyKeePass, target_kp: PyKeePass, entry_path: str) -> bool:
-    path_parts = entry_path.split("/")
-    title = path_parts[-1]
-    group_path = path_parts[:-1]
+def _append_binaries(kp: PyKeePass, binaries: List[bytes]):
+    # Like kp.add_binary, which rebuilds the whole binary list on every call
+    if kp.version >= (4, 0):
+        # The first byte is the protected flag
+        kp.payload.inner_header.binary.extend(
+            Container(type="binary", data=b"\x01" + data) for data in binaries
+        )
+        return
 
-    source_entry = None
-    for entry in source_kp.entries:
-        if entry.title == title and [g for g in entry.path[:-1]] == group_path:
-            source_entry = entry
-            break
+    meta = kp.tree.getroot().find("Meta")
+    pool = meta.find("Binaries")
+    if pool is None:
+        pool = etree.SubElement(meta, "Binaries")
+    first_id = len(kp.binaries)
+    for i, data in enumerate(binaries):
+        compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, zlib.MAX_WBITS | 16
+        )
+        data = compressor.compress(data) + compressor.flush()
+        binary = etree.SubElement(pool, "Binary", ID=str(first_id + i))
+        binary.set("Compressed", "True")
+        binary.text = base64.b64encode(data).decode()
 
-    if not source_entry:
-        return False
-
-    current_group = target_kp.root_group
-    for group_name in group_path:
-        next_group = next((g for g in current_group.subgroups if g == group_name), None)
-        if not next_group:
-            next_group = target_kp.add_group(current_group, group_name)
-        current_group = next_group
-
-    target_kp.add_entry(
-        current_group,
-        title=source_entry.title,
-        username=source_entry.username,
-        password=source_entry.password,
-        url=source_entry.url,
-        notes=source_entry.notes,
-    )
-    return True
+
+def _copy_binaries(source_kp: PyKeePass, target_kp: PyKeePass, *subtrees):
+    # Each attachment is pointed at a target binary with the same content,
+    # binaries the target lacks are appended to its pool once
+    refs = [
+        value
+        for subtree in subtrees
+        for value in subtree.iter("Value")
+        if "Ref" in value.attrib
+    ]
+    if not refs:
+        return
+    source_binaries = source_kp.binaries
+    target_binaries = target_kp.binaries
+    target_ids = {}
+    for i, data in enumerate(target_binaries):
+        target_ids.setdefault(data, i)
+
+    added = []
+    for value in refs:
+        ref = int(value.get("Ref"))
+        if ref >= len(source_binaries):
+            continue
+        data = source_binaries[ref]
+        if data not in target_ids:
+            target_ids[data] = len(target_binaries) + len(added)
+            added.append(data)
+        value.set("Ref", str(target_ids[data]))
+    _append_binaries(target_kp, added)
+
+
+def _copy_custom_icons(source_kp: PyKeePass, target_kp: PyKeePass, *subtrees):
+    wanted = {
+        icon.text for subtree in subtrees for icon in subtree.iter("CustomIconUUID")
+    }
+    source_icons = source_kp.tree.getroot().find("Meta/CustomIcons")
+    if not wanted or source_icons is None:
+        return
+    meta = target_kp.tree.getroot().find("Meta")
+    target_icons = meta.find("CustomIcons")
+    if target_icons is None:
+        target_icons = etree.SubElement(meta, "CustomIcons")
+    present = {element_text(icon, "UUID") for icon in target_icons}
+    for icon in source_icons:
+        uuid = element_text(icon, "UUID")
+        if uuid in wanted and uuid not in present:
+            target_icons.append(deepcopy(icon))
+
+
+def _assign_uuids(target_kp: PyKeePass, *subtrees, preserve_uuids: bool):
+    # A preserved UUID that the target already uses is replaced anyway, two
+    # objects with one UUID would be the same object to KeePass
+    taken = {uuid.text for uuid in target_kp.tree.getroot().iter("UUID")}
+    elements = [
+        element for subtree in subtrees for element in subtree.iter("Group", "Entry")
+    ]
+    for element in elements:
+        parent = element.getparent()
+        if parent is not None and parent.tag == "History":
+            continue
+        uuid = element.find("UUID")
+        if preserve_uuids and uuid.text not in taken:
+            taken.add(uuid.text)
+            continue
+        uuid.text = base64.b64encode(uuid4().bytes).decode()
+        taken.add(uuid.text)
+        # Older versions of an entry share its UUID
+        for old in element.iterfind("History/Entry/UUID"):
+            old.text = uuid.text
+
+
+@profiled("merge_group")
+def merge_group(
+    source_kp: PyKeePass,
+    target_kp: PyKeePass,
+    group_path: str,
+    source_index: Optional[DatabaseIndex] = None,
+    target_index: Optional[DatabaseIndex] = None,
+    preserve_uuids: bool = False,
+    save: bool = True,
+) -> List[str]:
+    # Copies the whole subtree with every field, attachment, icon and history
+    # item in one tree operation. Only groups missing from the target are
+    # copied. Returns the paths of the copied entries.
+    if source_index is None:
+        source_index = index_database(source_kp)
+    if target_index is None:
+        target_index = index_database(target_kp)
+    source_group = _find_group(source_kp, group_path, source_index)
+    if not group_path or source_group is None or group_path in target_index.groups:
+        return []
+
+    subtree = deepcopy(source_group._element)
+    _copy_binaries(source_kp, target_kp, subtree)
+    _copy_custom_icons(source_kp, target_kp, subtree)
+    _assign_uuids(target_kp, subtree, preserve_uuids=preserve_uuids)
+
+    parts = group_path.split("/")
+    parent = _resolve_group(target_kp, parts[:-1], target_index)
+    parent._element.append(subtree)
+
+    copied = _index_elements(target_index, target_kp, walk_group(subtree, tuple(parts)))
+
+    if save:
+        save_database(target_kp)
+    return copied
+
+
+def update_entry(source_entry: Entry, target_entry: Entry):
+    # Takes the whole source entry like merge_entry does, with its times,
+    # custom strings, attachments and history. The target entry keeps its
+    # UUID and place, and its old version goes into History.
+    source_kp, target_kp = source_entry._kp, target_entry._kp
+    element = target_entry._element
+    updated = deepcopy(source_entry._element)
+    _copy_binaries(source_kp, target_kp, updated)
+    _copy_custom_icons(source_kp, target_kp, updated)
+    uuid = element_text(element, "UUID")
+    for field in updated.iter("UUID"):
+        field.text = uuid
+
+    history = updated.find("History")
+    if history is None:
+        history = etree.SubElement(updated, "History")
+    previous = deepcopy(element)
+    for old in previous.findall("History"):
+        previous.remove(old)
+    # Revisions of both sides by modification time, one per time
+    revisions = {}
+    for kp, revision in (
+        [(source_kp, revision) for revision in history]
+        + [(target_kp, revision) for revision in element.iterfind("History/Entry")]
+        + [(target_kp, previous)]
+    ):
+        revisions.setdefault(Entry(element=revision, kp=kp).mtime, revision)
+    history[:] = [
+        revisions[mtime]
+        for mtime in sorted(revisions, key=lambda t: (t is not None, t or 0))
+    ]
+
+    element.getparent().replace(element, updated)
+    target_entry._element = updated
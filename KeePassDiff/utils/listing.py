@@ -0,0 +1,46 @@
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+
+
+# Sorted view over the paths of one diff list that answers the filters of the
+# list widgets without touching the databases again.
+class PathListing:
+    def __init__(self, paths: List[str]):
+        self.paths = sorted(paths)
+        self._titles = [path.rsplit("/", 1)[-1].lower() for path in self.paths]
+        self._groups: Dict[str, List[int]] = {}
+        for i, path in enumerate(self.paths):
+            group = path.rsplit("/", 1)[0] if "/" in path else ""
+            self._groups.setdefault(group, []).append(i)
+
+    @property
+    def groups(self) -> List[str]:
+        return sorted(self._groups)
+
+    def _prefix_range(self, prefix: str) -> Tuple[int, int]:
+        if not prefix:
+            return 0, len(self.paths)
+        start = bisect_left(self.paths, prefix)
+        # Every path starting with prefix sorts before prefix + U+10FFFF
+        end = bisect_left(self.paths, prefix + "\U0010ffff", start)
+        return start, end
+
+    def filter(
+        self, prefix: str = "", title: str = "", group: Optional[str] = None
+    ) -> List[str]:
+        start, end = self._prefix_range(prefix)
+        if group is not None:
+            positions = [i for i in self._groups.get(group, []) if start <= i < end]
+        else:
+            positions = range(start, end)
+
+        title = title.lower()
+        return [
+            self.paths[i] for i in positions if not title or title in self._titles[i]
+        ]
+
+
+def page_slice(items: List, page: int, page_size: int) -> Tuple[List, int]:
+    pages = max(1, -(-len(items) // page_size))
+    page = min(max(page, 1), pages)
+    return items[(page - 1) * page_size : page * page_size], pages
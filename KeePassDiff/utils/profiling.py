@@ -0,0 +1,142 @@
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+
+class Span(NamedTuple):
+    name: str
+    wall_seconds: float
+    # CPU time of the whole process while the span was open
+    cpu_seconds: float
+    # Peak traced memory above the level at span start, None when not traced
+    peak_bytes: Optional[int]
+
+
+_hooks: List[Callable[[Span], None]] = []
+_active: ContextVar[Optional["Profiler"]] = ContextVar("profiler", default=None)
+
+
+def add_hook(hook: Callable[[Span], None]):
+    # Hooks receive every finished span, with or without an active profiler
+    _hooks.append(hook)
+
+
+def remove_hook(hook: Callable[[Span], None]):
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+
+class Profiler:
+    def __init__(self, trace_memory: bool = True):
+        self.trace_memory = trace_memory
+        self.spans: List[Span] = []
+        # [memory at start, highest peak seen so far] per open span
+        self._memory_stack: List[List[int]] = []
+        self._started_tracing = False
+        self._thread = threading.main_thread()
+
+    @contextmanager
+    def activate(self):
+        self._thread = threading.current_thread()
+        token = _active.set(self)
+        try:
+            yield self
+        finally:
+            _active.reset(token)
+
+    def _enter_memory(self) -> bool:
+        # tracemalloc is process wide, so memory is only followed on the thread
+        # that activated the profiler, where spans nest properly
+        if not self.trace_memory or threading.current_thread() is not self._thread:
+            return False
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        current, peak = tracemalloc.get_traced_memory()
+        if self._memory_stack:
+            self._memory_stack[-1][1] = max(self._memory_stack[-1][1], peak)
+        tracemalloc.reset_peak()
+        self._memory_stack.append([current, current])
+        return True
+
+    def _exit_memory(self) -> int:
+        _, peak = tracemalloc.get_traced_memory()
+        start, seen = self._memory_stack.pop()
+        peak = max(peak, seen)
+        if self._memory_stack:
+            self._memory_stack[-1][1] = max(self._memory_stack[-1][1], peak)
+        elif self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        return peak - start
+
+    def record(self, span: Span):
+        self.spans.append(span)
+
+    def summary(self) -> List[Dict]:
+        totals: Dict[str, Dict] = {}
+        for span in self.spans:
+            total = totals.setdefault(
+                span.name,
+                {
+                    "name": span.name,
+                    "count": 0,
+                    "wall_seconds": 0.0,
+                    "cpu_seconds": 0.0,
+                    "peak_bytes": None,
+                },
+            )
+            total["count"] += 1
+            total["wall_seconds"] += span.wall_seconds
+            total["cpu_seconds"] += span.cpu_seconds
+            if span.peak_bytes is not None:
+                total["peak_bytes"] = max(total["peak_bytes"] or 0, span.peak_bytes)
+        return list(totals.values())
+
+
+@contextmanager
+def span(name: str):
+    profiler = _active.get()
+    if profiler is None and not _hooks:
+        yield
+        return
+
+    traced = profiler is not None and profiler._enter_memory()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield
+    finally:
+        emit(
+            Span(
+                name,
+                time.perf_counter() - wall_start,
+                time.process_time() - cpu_start,
+                profiler._exit_memory() if traced else None,
+            )
+        )
+
+
+def emit(finished: Span):
+    # Also used for spans measured elsewhere, like in a worker process
+    profiler = _active.get()
+    if profiler is not None:
+        profiler.record(finished)
+    for hook in list(_hooks):
+        hook(finished)
+
+
+def profiled(name: str):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
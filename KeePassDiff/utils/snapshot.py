@@ -0,0 +1,323 @@
+import base64
+import binascii
+import hashlib
+import struct
+import sys
+import weakref
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit
+from uuid import UUID
+
+from pykeepass import PyKeePass
+from pykeepass.entry import Entry, reserved_keys
+
+from KeePassDiff.utils.database import element_text, join_path, walk_tree
+from KeePassDiff.utils.profiling import profiled
+
+STRING_FIELDS = {
+    "UserName": "username",
+    "Password": "password",
+    "URL": "url",
+    "Notes": "notes",
+}
+_EPOCH = datetime(1, 1, 1, tzinfo=timezone.utc)
+
+
+class EntrySnapshot(NamedTuple):
+    uuid: Optional[UUID]
+    path: str
+    # Digest over all field hashes, equal fingerprints mean equal entries
+    fingerprint: bytes
+    # Field name -> digest of its value. Custom strings are keyed as
+    # "string:<key>" and attachments as "attachment:<filename>", "history"
+    # covers all revisions
+    fields: Dict[str, bytes]
+    # Names of the enclosing groups, one tuple shared by a group's entries
+    group: Tuple[str, ...] = ()
+    title: Optional[str] = None
+    ctime: Optional[datetime] = None
+    mtime: Optional[datetime] = None
+    # Fingerprints of the history revisions, oldest first
+    history: Tuple[bytes, ...] = ()
+    # Digest of the host name of the URL, shared by entries of one site
+    url_host: Optional[bytes] = None
+
+
+def _hash(data) -> bytes:
+    if data is None:
+        data = b""
+    elif not isinstance(data, bytes):
+        data = str(data).encode()
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+# The digest of a missing or empty field
+EMPTY_FIELD = _hash(None)
+
+
+def _fingerprint(fields: Dict[str, bytes]) -> bytes:
+    digest = hashlib.blake2b(digest_size=16)
+    for name in sorted(fields):
+        digest.update(name.encode() + b"\0" + fields[name])
+    return digest.digest()
+
+
+def url_host(url: Optional[str]) -> Optional[bytes]:
+    if not url:
+        return None
+    # Bare host names like "example.com/login" are common in vaults
+    if "://" not in url:
+        url = "//" + url
+    try:
+        host = urlsplit(url).hostname
+    except ValueError:
+        return None
+    return _hash(host.removeprefix("www.")) if host else None
+
+
+def decode_time(text: Optional[str], kdbx4: bool) -> Optional[datetime]:
+    # KDBX4 stores seconds since year 1 as base64, KDBX3 an ISO timestamp.
+    # Both decode to the same aware datetime pykeepass returns, so one entry
+    # saved in either format hashes the same.
+    if text is None:
+        return None
+    if kdbx4:
+        try:
+            seconds = struct.unpack("<Q", base64.b64decode(text))[0]
+            return _EPOCH + timedelta(seconds=seconds)
+        except (binascii.Error, struct.error):
+            pass
+    return datetime.fromisoformat(text.replace("Z", "+00:00")).replace(
+        tzinfo=timezone.utc
+    )
+
+
+def _snapshot_element(
+    element,
+    group_path: Tuple[str, ...],
+    binary_hashes: List[bytes],
+    kdbx4: bool,
+    entry_path: Optional[str] = None,
+) -> EntrySnapshot:
+    # Reads every field of the entry in one pass over its children
+    fields = dict.fromkeys(STRING_FIELDS.values(), EMPTY_FIELD)
+    title = uuid = ctime = mtime = host = None
+    history = ()
+    for child in element:
+        tag = child.tag
+        if tag == "String":
+            key = element_text(child, "Key")
+            value = element_text(child, "Value")
+            if key == "Title":
+                title = value
+            elif key in STRING_FIELDS:
+                fields[STRING_FIELDS[key]] = _hash(value)
+                if key == "URL":
+                    host = url_host(value)
+            elif key not in reserved_keys:
+                fields[sys.intern(f"string:{key}")] = _hash(value)
+        elif tag == "Binary":
+            ref = int(child.find("Value").attrib["Ref"])
+            digest = binary_hashes[ref] if ref < len(binary_hashes) else EMPTY_FIELD
+            fields[f"attachment:{element_text(child, 'Key')}"] = digest
+        elif tag == "UUID" and child.text:
+            uuid = UUID(bytes=base64.b64decode(child.text))
+        elif tag == "Times":
+            ctime = decode_time(element_text(child, "CreationTime"), kdbx4)
+            mtime = decode_time(element_text(child, "LastModificationTime"), kdbx4)
+        elif tag == "History":
+            history = tuple(
+                _revision_fingerprint(revision, binary_hashes, kdbx4)
+                for revision in child
+            )
+    fields["mtime"] = _hash(mtime)
+    # The same revisions in another order are the same history
+    fields["history"] = _hash(b"".join(sorted(history)))
+
+    return EntrySnapshot(
+        uuid=uuid,
+        path=entry_path if entry_path is not None else join_path(group_path, title),
+        fingerprint=_fingerprint(fields),
+        fields=fields,
+        group=group_path,
+        title=title,
+        ctime=ctime,
+        mtime=mtime,
+        history=history,
+        url_host=host,
+    )
+
+
+def _revision_fingerprint(element, binary_hashes: List[bytes], kdbx4: bool) -> bytes:
+    revision = _snapshot_element(element, (), binary_hashes, kdbx4, "")
+    # Revisions have no path of their own, a renamed one differs in its title
+    return _fingerprint({**revision.fields, "title": _hash(revision.title)})
+
+
+def _stored_binaries(kp: PyKeePass) -> List:
+    # The binary pool as stored, read without decoding anything
+    if kp.version >= (4, 0):
+        return [binary.data for binary in kp.payload.inner_header.binary]
+    stored = {}
+    for element in kp.tree.getroot().iterfind("Meta/Binaries/Binary"):
+        stored[int(element.attrib["ID"])] = (
+            element.get("Compressed") == "True",
+            element.text or "",
+        )
+    return [stored[i] for i in sorted(stored)]
+
+
+def _hash_stored(stored) -> bytes:
+    if isinstance(stored, bytes):
+        # KDBX4, the first byte is the protected flag
+        return hashlib.blake2b(memoryview(stored)[1:], digest_size=16).digest()
+    compressed, text = stored
+    data = base64.b64decode(text)
+    if compressed:
+        data = zlib.decompress(data, zlib.MAX_WBITS | 32)
+    return _hash(data)
+
+
+# kp -> [(stored binary, digest)] in pool order. Dropped with the database.
+_binary_hashes: "weakref.WeakKeyDictionary[PyKeePass, List[Tuple]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def hash_binaries(kp: PyKeePass) -> List[bytes]:
+    # Each binary is decoded and hashed once, however many attachments and
+    # revisions reference it. Later calls only hash binaries that were added
+    # or replaced since, so snapshots after a merge skip the whole pool.
+    known = _binary_hashes.get(kp, [])
+    hashes = []
+    for i, stored in enumerate(_stored_binaries(kp)):
+        if i < len(known) and (known[i][0] is stored or known[i][0] == stored):
+            hashes.append(known[i])
+        else:
+            hashes.append((stored, _hash_stored(stored)))
+    _binary_hashes[kp] = hashes
+    return [digest for _, digest in hashes]
+
+
+def snapshot_entry(
+    entry: Entry, entry_path: str, binary_hashes: Optional[List[bytes]] = None
+) -> EntrySnapshot:
+    element = entry._element
+    if binary_hashes is None:
+        binary_hashes = hash_binaries(entry._kp)
+
+    group_path = []
+    parent = element.getparent()
+    while parent is not None and parent.getparent().tag == "Group":
+        name = element_text(parent, "Name")
+        if name is not None:
+            group_path.append(name)
+        parent = parent.getparent()
+
+    return _snapshot_element(
+        element,
+        tuple(reversed(group_path)),
+        binary_hashes,
+        entry._kp.version >= (4, 0),
+        entry_path,
+    )
+
+
+def snapshot_entries(kp: PyKeePass) -> List[EntrySnapshot]:
+    # Every entry in document order, built straight from the XML in one walk.
+    # Entries sharing a path are all kept, for callers matching by UUID.
+    binary_hashes = hash_binaries(kp)
+    kdbx4 = kp.version >= (4, 0)
+    return [
+        _snapshot_element(element, group_path, binary_hashes, kdbx4)
+        for group_path, element in walk_tree(kp)
+        if element.tag == "Entry"
+    ]
+
+
+@profiled("snapshot_database")
+def snapshot_database(kp: PyKeePass) -> Dict[str, EntrySnapshot]:
+    # Keyed like DatabaseIndex.entries, the first entry of a path wins
+    snapshots: Dict[str, EntrySnapshot] = {}
+    for snapshot in snapshot_entries(kp):
+        snapshots.setdefault(snapshot.path, snapshot)
+    return snapshots
+
+
+class GroupNode(NamedTuple):
+    path: str
+    # Digest over the names and digests of child groups and the titles and
+    # fingerprints of entries. The group's own name is left out, so a renamed
+    # or moved group keeps its digest.
+    digest: bytes
+    # Entries in the whole subtree
+    entries: int
+    children: Dict[str, "GroupNode"]
+
+
+def _parent_group(group_path: str) -> str:
+    return group_path.rsplit("/", 1)[0] if "/" in group_path else ""
+
+
+def group_tree(
+    group_paths: Iterable[str], snapshots: Dict[str, EntrySnapshot]
+) -> GroupNode:
+    # Built bottom-up from the snapshots, no database access needed
+    known = {""}
+    children: Dict[str, Dict[str, str]] = {}
+    contents: Dict[str, List[bytes]] = {}
+
+    def add_group(group_path: str):
+        # Parents missing from group_paths are filled in on the way up
+        while group_path not in known:
+            known.add(group_path)
+            parent = _parent_group(group_path)
+            name = group_path.rsplit("/", 1)[-1]
+            children.setdefault(parent, {})[name] = group_path
+            group_path = parent
+
+    for group_path in group_paths:
+        add_group(group_path)
+    for snapshot in snapshots.values():
+        group_path = "/".join(snapshot.group)
+        add_group(group_path)
+        contents.setdefault(group_path, []).append(
+            b"e" + (snapshot.title or "").encode() + b"\0" + snapshot.fingerprint
+        )
+
+    def build(group_path: str) -> GroupNode:
+        nodes = {
+            name: build(path) for name, path in children.get(group_path, {}).items()
+        }
+        own = contents.get(group_path, [])
+        lines = own + [
+            b"g" + name.encode() + b"\0" + n.digest for name, n in nodes.items()
+        ]
+        digest = hashlib.blake2b(digest_size=16)
+        for line in sorted(lines):
+            digest.update(line)
+        entries = len(own) + sum(node.entries for node in nodes.values())
+        return GroupNode(group_path, digest.digest(), entries, nodes)
+
+    return build("")
+
+
+def history_changes(first: EntrySnapshot, second: EntrySnapshot) -> Tuple[int, int]:
+    # Revisions only the first and only the second entry has
+    first_history, second_history = set(first.history), set(second.history)
+    return (
+        len(first_history - second_history),
+        len(second_history - first_history),
+    )
+
+
+def changed_fields(first: EntrySnapshot, second: EntrySnapshot) -> List[str]:
+    if first.fingerprint == second.fingerprint:
+        return []
+    return sorted(
+        name
+        for name in first.fields.keys() | second.fields.keys()
+        if first.fields.get(name) != second.fields.get(name)
+    )
@@ -0,0 +1,274 @@
+from copy import deepcopy
+from typing import Dict, List, Optional, Tuple
+
+from pykeepass import PyKeePass
+from pykeepass.entry import Entry
+
+from KeePassDiff.utils.database import (
+    DatabaseIndex,
+    _assign_uuids,
+    _copy_binaries,
+    _copy_custom_icons,
+    _resolve_group,
+    element_text,
+    index_database,
+    save_database,
+)
+from KeePassDiff.utils.profiling import profiled
+from KeePassDiff.utils.snapshot import (
+    _EPOCH,
+    STRING_FIELDS,
+    EntrySnapshot,
+    decode_time,
+    snapshot_entries,
+)
+
+STRING_KEYS = {field: key for key, field in STRING_FIELDS.items()}
+
+
+def _merge_fields(snapshot: EntrySnapshot) -> Dict:
+    # What a three-way merge resolves per entry. The title and group stand in
+    # for the path so that renames and moves merge like any other field. The
+    # modification time is not merged, it follows the fields that were taken.
+    fields = {name: value for name, value in snapshot.fields.items() if name != "mtime"}
+    fields["title"] = snapshot.title
+    fields["group"] = snapshot.group
+    return fields
+
+
+@profiled("compare_three_way")
+def _plan_three_way(
+    base: List[EntrySnapshot], left: List[EntrySnapshot], right: List[EntrySnapshot]
+) -> Dict:
+    # Entries are matched by UUID, so every entry costs a few dict lookups
+    # and the whole comparison is linear in the number of entries. The plan
+    # holds the snapshots, paths can repeat and do not name an entry.
+    base_by_uuid = {s.uuid: s for s in base if s.uuid is not None}
+    right_by_uuid = {s.uuid: s for s in right if s.uuid is not None}
+
+    updated, deleted, conflicts = [], [], []
+    for ours in left:
+        left_path = ours.path
+        ancestor = base_by_uuid.get(ours.uuid)
+        theirs = right_by_uuid.pop(ours.uuid, None)
+        if theirs is None:
+            if ancestor is None:
+                # Added on the left
+                continue
+            if ours.fingerprint == ancestor.fingerprint and ours.path == ancestor.path:
+                deleted.append(ours)
+            else:
+                conflicts.append({"path": left_path, "deleted_in": "right"})
+            continue
+        if ours.fingerprint == theirs.fingerprint and ours.path == theirs.path:
+            continue
+
+        ours_fields, theirs_fields = _merge_fields(ours), _merge_fields(theirs)
+        ancestor_fields = _merge_fields(ancestor) if ancestor is not None else {}
+        taken, conflicting = [], []
+        for name in sorted(ours_fields.keys() | theirs_fields.keys()):
+            value, other = ours_fields.get(name), theirs_fields.get(name)
+            if value == other:
+                continue
+            original = ancestor_fields.get(name)
+            if name == "history" or value == original:
+                # Revisions of both sides are kept, so histories never conflict
+                taken.append(name)
+            elif other != original:
+                conflicting.append(name)
+        if taken:
+            updated.append((ours, theirs, taken))
+        if conflicting:
+            conflicts.append({"path": left_path, "fields": conflicting})
+
+    added = []
+    for theirs in right_by_uuid.values():
+        ancestor = base_by_uuid.get(theirs.uuid)
+        if ancestor is None:
+            added.append(theirs)
+        elif theirs.fingerprint != ancestor.fingerprint or theirs.path != ancestor.path:
+            conflicts.append({"path": theirs.path, "deleted_in": "left"})
+        # Otherwise deleted on the left and unchanged on the right, gone
+
+    return {
+        "updated": updated,
+        "added": added,
+        "deleted": deleted,
+        "conflicts": conflicts,
+    }
+
+
+def _report(plan: Dict) -> Dict:
+    # The plan by paths, as reported to the user
+    return {
+        "updated": [
+            (ours.path, theirs.path, fields) for ours, theirs, fields in plan["updated"]
+        ],
+        "added": sorted(theirs.path for theirs in plan["added"]),
+        "deleted": sorted(ours.path for ours in plan["deleted"]),
+        "conflicts": plan["conflicts"],
+    }
+
+
+def compare_three_way(
+    base: List[EntrySnapshot], left: List[EntrySnapshot], right: List[EntrySnapshot]
+) -> Dict:
+    # Takes every entry of each database, as from snapshot_entries
+    return _report(_plan_three_way(base, left, right))
+
+
+def _child(element, tag: str, key: str):
+    for child in element.iterchildren(tag):
+        if element_text(child, "Key") == key:
+            return child
+    return None
+
+
+# Children that come after strings and attachments in an entry
+_FOLLOWING = {
+    "String": ("Binary", "AutoType", "History"),
+    "Binary": ("AutoType", "History"),
+}
+
+
+def _insert_field(element, field):
+    # Keeps the order of the KDBX schema, which KeePass relies on
+    for i, child in enumerate(element):
+        if child.tag in _FOLLOWING[field.tag]:
+            element.insert(i, field)
+            return
+    element.append(field)
+
+
+def _field_element(name: str) -> Tuple[str, str]:
+    if name.startswith("string:"):
+        return "String", name[len("string:") :]
+    if name.startswith("attachment:"):
+        return "Binary", name[len("attachment:") :]
+    if name == "title":
+        return "String", "Title"
+    return "String", STRING_KEYS[name]
+
+
+def _merge_history(
+    ours: Entry,
+    theirs: Entry,
+    snapshots: Tuple[EntrySnapshot, EntrySnapshot],
+    kdbx4: bool,
+) -> list:
+    # Revisions the left lacks are copied over by fingerprint, then all are
+    # put in time order. Returns the copies.
+    history = ours._element.find("History")
+    if history is None:
+        history = ours._element.makeelement("History", {})
+        ours._element.append(history)
+    known = set(snapshots[0].history)
+    copied = []
+    for fingerprint, revision in zip(
+        snapshots[1].history, theirs._element.iterfind("History/Entry")
+    ):
+        if fingerprint not in known:
+            known.add(fingerprint)
+            copied.append(deepcopy(revision))
+            history.append(copied[-1])
+
+    def modified(revision):
+        text = element_text(revision.find("Times"), "LastModificationTime")
+        return decode_time(text, kdbx4) or _EPOCH
+
+    history[:] = sorted(history, key=modified)
+    return copied
+
+
+def _take_fields(
+    left_kp: PyKeePass,
+    left_index: DatabaseIndex,
+    ours: Entry,
+    theirs: Entry,
+    fields: List[str],
+    snapshots: Tuple[EntrySnapshot, EntrySnapshot],
+) -> list:
+    # Copies the fields from theirs to ours, returns the copied elements
+    copied = []
+    for name in fields:
+        if name == "history":
+            copied += _merge_history(ours, theirs, snapshots, left_kp.version >= (4, 0))
+            continue
+        if name == "group":
+            group = _resolve_group(left_kp, list(snapshots[1].group), left_index)
+            left_kp.move_entry(ours, group)
+            continue
+        # Strings and attachments are swapped element for element
+        tag, key = _field_element(name)
+        old = _child(ours._element, tag, key)
+        new = _child(theirs._element, tag, key)
+        if new is not None:
+            new = deepcopy(new)
+            copied.append(new)
+            if old is None:
+                _insert_field(ours._element, new)
+            else:
+                ours._element.replace(old, new)
+        elif old is not None:
+            ours._element.remove(old)
+
+    if theirs.mtime and (not ours.mtime or theirs.mtime > ours.mtime):
+        ours.mtime = theirs.mtime
+    return copied
+
+
+@profiled("merge_three_way")
+def merge_three_way(
+    base_kp: PyKeePass,
+    left_kp: PyKeePass,
+    right_kp: PyKeePass,
+    left_index: Optional[DatabaseIndex] = None,
+    right_index: Optional[DatabaseIndex] = None,
+    save: bool = True,
+) -> Dict:
+    # Merges into left_kp what changed on the right since base. A field that
+    # changed on one side only is taken from that side, a field changed on
+    # both sides differently is a conflict and keeps the left value. Returns
+    # the plan from compare_three_way that was applied.
+    if left_index is None:
+        left_index = index_database(left_kp)
+    if right_index is None:
+        right_index = index_database(right_kp)
+    plan = _plan_three_way(
+        snapshot_entries(base_kp), snapshot_entries(left_kp), snapshot_entries(right_kp)
+    )
+
+    # Entries are looked up by UUID before any of them moves
+    updates = [
+        (
+            left_index.entries_by_uuid[ours.uuid],
+            right_index.entries_by_uuid[theirs.uuid],
+            fields,
+            (ours, theirs),
+        )
+        for ours, theirs, fields in plan["updated"]
+    ]
+    deletions = [left_index.entries_by_uuid[ours.uuid] for ours in plan["deleted"]]
+
+    copied = []
+    for ours, theirs, fields, snapshots in updates:
+        copied += _take_fields(left_kp, left_index, ours, theirs, fields, snapshots)
+    for entry in deletions:
+        left_kp.delete_entry(entry)
+
+    added = [
+        deepcopy(right_index.entries_by_uuid[theirs.uuid]._element)
+        for theirs in plan["added"]
+    ]
+    # Before they are in the tree, where their UUIDs would count as taken
+    _assign_uuids(left_kp, *added, preserve_uuids=True)
+    for theirs, element in zip(plan["added"], added):
+        group = _resolve_group(left_kp, list(theirs.group), left_index)
+        group._element.append(element)
+    _copy_custom_icons(right_kp, left_kp, *added)
+    # One pass over both binary pools for everything copied from the right
+    _copy_binaries(right_kp, left_kp, *copied, *added)
+
+    if save:
+        save_database(left_kp)
+    return _report(plan)
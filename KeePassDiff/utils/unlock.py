@@ -0,0 +1,255 @@
+import io
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextvars import copy_context
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from pykeepass import PyKeePass
+from pykeepass.kdbx_parsing.kdbx import KDBX
+from pykeepass.kdbx_parsing.kdbx4 import kdf_uuids
+
+from KeePassDiff.utils.database import (
+    DatabaseCache,
+    database_digest,
+    open_database_bytes,
+    read_file_bytes,
+)
+from KeePassDiff.utils.profiling import Span, emit, profiled, span
+
+
+class UnlockRequest(NamedTuple):
+    name: str
+    db_bytes: bytes
+    password: Optional[str] = None
+    keyfile_bytes: Optional[bytes] = None
+    # A key derived earlier for the same credentials and KDF parameters skips
+    # the KDF entirely
+    transformed_key: Optional[bytes] = None
+
+
+class UnlockResult(NamedTuple):
+    name: str
+    kp: Optional[PyKeePass] = None
+    error: Optional[Exception] = None
+    # Passed back to save_database and export_database so saves skip the KDF
+    transformed_key: Optional[bytes] = None
+
+
+def _parse_header(db_bytes: bytes):
+    try:
+        return KDBX.subcons[0].parse(db_bytes).value
+    except Exception:
+        # Let the actual open report the broken header
+        return None
+
+
+def kdf_releases_gil(db_bytes: bytes) -> bool:
+    # argon2-cffi hashes outside the GIL, AES-KDF rounds are a Python loop
+    header = _parse_header(db_bytes)
+    if header is None:
+        return True
+    if header.major_version == 3:
+        return False
+    kdf = header.dynamic_header.kdf_parameters.data.dict["$UUID"].value
+    return kdf != kdf_uuids["aeskdf"]
+
+
+def kdf_digest(
+    db_bytes: bytes,
+    password: Optional[str] = None,
+    keyfile_bytes: Optional[bytes] = None,
+) -> Optional[str]:
+    # Everything the transformed key depends on: the credentials and the KDF
+    # parameters with their salt. Seeds that change on every save are left
+    # out, so a database saved with its key keeps the same digest.
+    header = _parse_header(db_bytes)
+    if header is None:
+        return None
+    dynamic_header = header.dynamic_header
+    if header.major_version == 3:
+        kdf = (
+            dynamic_header.transform_seed.data
+            + str(dynamic_header.transform_rounds.data).encode()
+        )
+    else:
+        parameters = dynamic_header.kdf_parameters.data.dict
+        kdf = repr(
+            [(name, parameters[name].value) for name in sorted(parameters)]
+        ).encode()
+    return database_digest(kdf, password, keyfile_bytes)
+
+
+def derive_transformed_key(
+    db_bytes: bytes,
+    password: Optional[str] = None,
+    keyfile_bytes: Optional[bytes] = None,
+) -> bytes:
+    # Runs the KDF only, the payload is decrypted by whoever receives the key
+    return PyKeePass(
+        io.BytesIO(db_bytes),
+        password=password,
+        keyfile=io.BytesIO(keyfile_bytes) if keyfile_bytes else None,
+        decrypt=False,
+    ).transformed_key
+
+
+def _derive_timed(
+    db_bytes: bytes,
+    password: Optional[str] = None,
+    keyfile_bytes: Optional[bytes] = None,
+) -> Tuple[bytes, Span]:
+    # Worker processes have no profiler, so the span travels back with the key
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    transformed_key = derive_transformed_key(db_bytes, password, keyfile_bytes)
+    return transformed_key, Span(
+        "kdf",
+        time.perf_counter() - wall_start,
+        time.process_time() - cpu_start,
+        None,
+    )
+
+
+def _open_split(
+    db_bytes: bytes,
+    password: Optional[str] = None,
+    keyfile_bytes: Optional[bytes] = None,
+    transformed_key: Optional[bytes] = None,
+) -> Tuple[PyKeePass, bytes]:
+    # Same work as a plain open, split so KDF and decrypt/parse are timed apart
+    if transformed_key is None:
+        with span("kdf"):
+            transformed_key = derive_transformed_key(db_bytes, password, keyfile_bytes)
+    with span("decrypt"):
+        kp = open_database_bytes(db_bytes, password, keyfile_bytes, transformed_key)
+    return kp, transformed_key
+
+
+@profiled("unlock")
+def unlock_databases(
+    requests: List[UnlockRequest],
+    max_workers: Optional[int] = None,
+    use_processes: Optional[bool] = None,
+    on_unlocked: Optional[Callable[[UnlockResult], None]] = None,
+) -> List[UnlockResult]:
+    results: List[Optional[UnlockResult]] = [None] * len(requests)
+
+    def finish(i: int, result: UnlockResult):
+        results[i] = result
+        if on_unlocked:
+            on_unlocked(result)
+
+    # Requests with a known key only decrypt, which needs no pool. A key that
+    # no longer fits is dropped and derived again below.
+    requests = list(requests)
+    pending = []
+    for i, request in enumerate(requests):
+        if request.transformed_key is not None:
+            try:
+                kp, key = _open_split(
+                    request.db_bytes,
+                    request.password,
+                    request.keyfile_bytes,
+                    request.transformed_key,
+                )
+                finish(i, UnlockResult(request.name, kp, transformed_key=key))
+                continue
+            except Exception:
+                requests[i] = request._replace(transformed_key=None)
+        pending.append(i)
+
+    if not pending:
+        return results
+    if use_processes is None:
+        use_processes = not all(kdf_releases_gil(requests[i].db_bytes) for i in pending)
+
+    # A process pool only derives the keys, lxml trees cannot cross processes
+    if use_processes:
+        executor = ProcessPoolExecutor(
+            max_workers or len(pending),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        task = _derive_timed
+    else:
+        executor = ThreadPoolExecutor(max_workers or len(pending))
+        task = _open_split
+
+    def arguments(request: UnlockRequest) -> Tuple:
+        if not use_processes:
+            # Threads carry the caller's context so their spans are recorded
+            return (
+                copy_context().run,
+                task,
+                request.db_bytes,
+                request.password,
+                request.keyfile_bytes,
+            )
+        # Memory views of uploads cannot be pickled to a worker process
+        return (
+            task,
+            bytes(request.db_bytes),
+            request.password,
+            bytes(request.keyfile_bytes) if request.keyfile_bytes else None,
+        )
+
+    with executor:
+        futures = {executor.submit(*arguments(requests[i])): i for i in pending}
+        for future in as_completed(futures):
+            i = futures[future]
+            request = requests[i]
+            try:
+                if use_processes:
+                    transformed_key, kdf_span = future.result()
+                    emit(kdf_span)
+                    with span("decrypt"):
+                        kp = open_database_bytes(
+                            request.db_bytes,
+                            request.password,
+                            request.keyfile_bytes,
+                            transformed_key=transformed_key,
+                        )
+                else:
+                    kp, transformed_key = future.result()
+                finish(i, UnlockResult(request.name, kp, None, transformed_key))
+            except Exception as e:
+                finish(i, UnlockResult(request.name, error=e))
+
+    return results
+
+
+def unlock_cached(
+    cache: DatabaseCache,
+    uploads: Dict[str, Tuple],
+    on_unlocked: Optional[Callable[[UnlockResult], None]] = None,
+    **kwargs,
+) -> Dict[str, UnlockResult]:
+    # uploads maps a cache slot to its (db_file, password, keyfile)
+    results, requests, digests = {}, [], {}
+    for slot, (db_file, password, keyfile) in uploads.items():
+        db_bytes = read_file_bytes(db_file, "db_file")
+        keyfile_bytes = read_file_bytes(keyfile, "keyfile") if keyfile else None
+        digest = database_digest(db_bytes, password, keyfile_bytes)
+        key_digest = kdf_digest(db_bytes, password, keyfile_bytes)
+        # A key held for other credentials or KDF parameters is wiped here
+        transformed_key = cache.get_key(slot, key_digest)
+        kp = cache.get(slot, digest)
+        if kp is not None:
+            results[slot] = UnlockResult(slot, kp, transformed_key=transformed_key)
+            continue
+        # Same credentials for a new upload, like a re-uploaded export, keep
+        # the key and skip the KDF
+        cache.evict(slot, keep_key=True)
+        digests[slot] = (digest, key_digest)
+        requests.append(
+            UnlockRequest(slot, db_bytes, password, keyfile_bytes, transformed_key)
+        )
+
+    for result in unlock_databases(requests, on_unlocked=on_unlocked, **kwargs):
+        if result.kp is not None:
+            digest, key_digest = digests[result.name]
+            cache.put(result.name, digest, result.kp)
+            cache.put_key(result.name, key_digest, result.transformed_key)
+        results[result.name] = result
+
+    return {slot: results[slot] for slot in uploads}
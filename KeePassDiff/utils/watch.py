@@ -0,0 +1,206 @@
+import hashlib
+import io
+import os
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from KeePassDiff.utils.database import DatabaseCache
+from KeePassDiff.utils.snapshot import EntrySnapshot, snapshot_database
+from KeePassDiff.utils.unlock import unlock_cached
+
+
+class WatchedFile(NamedTuple):
+    size: int
+    mtime_ns: int
+    content_hash: bytes
+    # None until the file could be opened once
+    snapshots: Optional[Dict[str, EntrySnapshot]] = None
+
+
+def snapshot_changes(
+    old: Dict[str, EntrySnapshot], new: Dict[str, EntrySnapshot]
+) -> Dict[str, List[str]]:
+    return {
+        "entries_added": sorted(new.keys() - old.keys()),
+        "entries_removed": sorted(old.keys() - new.keys()),
+        "entries_changed": sorted(
+            path
+            for path in old.keys() & new.keys()
+            if old[path].fingerprint != new[path].fingerprint
+        ),
+    }
+
+
+def _row_keys(snapshots: Dict[str, EntrySnapshot]) -> Dict[Tuple, bytes]:
+    # Copies of one vault share UUIDs, so rows are matched by UUID and fall
+    # back to the path. Repeats within one copy get rows of their own.
+    keys = {}
+    for snapshot in snapshots.values():
+        base = snapshot.path if snapshot.uuid is None else snapshot.uuid
+        occurrence = 0
+        while (base, occurrence) in keys:
+            occurrence += 1
+        keys[(base, occurrence)] = snapshot.fingerprint
+    return keys
+
+
+# Polls the .kdbx files of one directory. A file is only read again when its
+# size or mtime changed, and only opened again when its content did too. Opens
+# reuse the key derived for the file before, and only the changed files get new
+# snapshots. Between scans just the snapshots and keys are kept in memory, not
+# the opened databases. The drift summary comes from rows kept across copies,
+# and a change only updates the rows of the copy that changed.
+class VaultWatcher:
+    def __init__(
+        self,
+        directory: str,
+        password: Optional[str] = None,
+        keyfile_bytes: Optional[bytes] = None,
+    ):
+        self.directory = directory
+        self.password = password
+        self.keyfile_bytes = keyfile_bytes
+        self.cache = DatabaseCache()
+        self.files: Dict[str, WatchedFile] = {}
+        # Row key -> {database path: fingerprint}
+        self.rows: Dict[Tuple, Dict[str, bytes]] = {}
+        # Rows by how many copies hold them, all of them and those identical
+        self.row_sizes: Counter = Counter()
+        self.identical_sizes: Counter = Counter()
+        self.diverged = 0
+
+    def _paths(self) -> List[str]:
+        return sorted(
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.lower().endswith(".kdbx")
+        )
+
+    def _count_row(self, key: Tuple, sign: int):
+        row = self.rows.get(key)
+        if not row:
+            return
+        self.row_sizes[len(row)] += sign
+        if len(set(row.values())) == 1:
+            self.identical_sizes[len(row)] += sign
+        else:
+            self.diverged += sign
+
+    def _update_rows(
+        self,
+        path: str,
+        old: Optional[Dict[str, EntrySnapshot]],
+        new: Optional[Dict[str, EntrySnapshot]],
+    ):
+        old_keys = _row_keys(old) if old else {}
+        new_keys = _row_keys(new) if new else {}
+        for key in old_keys.keys() | new_keys.keys():
+            self._count_row(key, -1)
+            row = self.rows.setdefault(key, {})
+            if key in new_keys:
+                row[path] = new_keys[key]
+            else:
+                del row[path]
+                if not row:
+                    del self.rows[key]
+            self._count_row(key, 1)
+
+    def _read_changed(self, path: str) -> Optional[Tuple[WatchedFile, bytes]]:
+        try:
+            stat = os.stat(path)
+            known = self.files.get(path)
+            if known and (known.size, known.mtime_ns) == (
+                stat.st_size,
+                stat.st_mtime_ns,
+            ):
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            # Gone between listing and reading, the next scan reports it
+            return None
+
+        # The stat is taken before reading, a write during the read shows up as
+        # another change on the next scan
+        content_hash = hashlib.blake2b(data, digest_size=16).digest()
+        if known and known.content_hash == content_hash:
+            self.files[path] = known._replace(
+                size=stat.st_size, mtime_ns=stat.st_mtime_ns
+            )
+            return None
+        watched = WatchedFile(
+            stat.st_size,
+            stat.st_mtime_ns,
+            content_hash,
+            known.snapshots if known else None,
+        )
+        return watched, data
+
+    def scan(self) -> List[Dict]:
+        events = []
+        paths = self._paths()
+        for path in sorted(self.files.keys() - set(paths)):
+            self._update_rows(path, self.files.pop(path).snapshots, None)
+            self.cache.evict(path)
+            events.append({"event": "removed", "database": path})
+
+        changed = {}
+        for path in paths:
+            read = self._read_changed(path)
+            if read is not None:
+                changed[path] = read
+        keyfile = io.BytesIO(self.keyfile_bytes) if self.keyfile_bytes else None
+        results = unlock_cached(
+            self.cache,
+            {
+                path: (io.BytesIO(data), self.password, keyfile)
+                for path, (_, data) in changed.items()
+            },
+        )
+
+        for path, result in results.items():
+            if result.error is not None:
+                # Often a copy still being written by the sync client. Its
+                # content is recorded with the last snapshots, so it is only
+                # opened again once its content changes, like when the sync
+                # finishes, and never again for a password it does not take.
+                self.files[path] = changed[path][0]
+                events.append(
+                    {"event": "error", "database": path, "error": str(result.error)}
+                )
+                continue
+            snapshots = snapshot_database(result.kp)
+            self.cache.evict(path, keep_key=True)
+            watched = changed[path][0]
+            old = watched.snapshots
+            self.files[path] = watched._replace(snapshots=snapshots)
+            self._update_rows(path, old, snapshots)
+            if old is None:
+                events.append(
+                    {"event": "added", "database": path, "entries": len(snapshots)}
+                )
+            else:
+                events.append(
+                    {
+                        "event": "changed",
+                        "database": path,
+                        **snapshot_changes(old, snapshots),
+                    }
+                )
+
+        if events:
+            events.append(self.summary())
+        return events
+
+    def summary(self) -> Dict:
+        # Drift across all copies from the kept rows, nothing is reopened or
+        # compared again. Counted like the summary of compare_many.
+        opened = [path for path, f in self.files.items() if f.snapshots is not None]
+        return {
+            "event": "summary",
+            "databases": opened,
+            "entries": len(self.rows),
+            "in_all": self.row_sizes[len(opened)],
+            "identical": self.identical_sizes[len(opened)],
+            "diverged": self.diverged,
+        }
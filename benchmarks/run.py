@@ -0,0 +1,138 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+from typing import Dict, List
+
+from benchmarks.vaults import generate_vault_pair
+from KeePassDiff.utils.comparison import compare_databases
+from KeePassDiff.utils.database import (
+    export_database,
+    get_entry_details,
+    index_database,
+    merge_entries,
+)
+from KeePassDiff.utils.profiling import Profiler, span
+from KeePassDiff.utils.snapshot import snapshot_database
+from KeePassDiff.utils.unlock import UnlockRequest, unlock_databases
+
+PASSWORD = "benchmark"
+
+
+STAGES = ("unlock", "index", "snapshot", "compare", "details", "merge", "export")
+
+
+def run_case(directory: str, entries: int, **options) -> Dict:
+    db1_path, db2_path = generate_vault_pair(
+        directory, entries=entries, password=PASSWORD, **options
+    )
+    requests = []
+    for path in (db1_path, db2_path):
+        with open(path, "rb") as f:
+            requests.append(UnlockRequest(path, f.read(), PASSWORD))
+
+    profiler = Profiler()
+    with profiler.activate():
+        with span("unlock"):
+            kp1, kp2 = [result.kp for result in unlock_databases(requests)]
+        with span("index"):
+            index1, index2 = index_database(kp1), index_database(kp2)
+        with span("snapshot"):
+            snapshots1 = snapshot_database(kp1)
+            snapshots2 = snapshot_database(kp2)
+        with span("compare"):
+            differences = compare_databases(
+                index1.as_sets(), index2.as_sets(), snapshots1, snapshots2
+            )
+        with span("details"):
+            for entry_path in differences["common_entries"][:1000]:
+                get_entry_details(kp1, entry_path, index1)
+        with span("merge"):
+            merge_entries(
+                kp2, kp1, differences["entries_only_in_db2"], index2, index1, save=False
+            )
+        with span("export"):
+            export_database(kp1)
+
+    # Only the stages themselves, spans of the instrumented functions nest inside
+    return {
+        s.name: {"seconds": s.wall_seconds, "peak_bytes": s.peak_bytes}
+        for s in profiler.spans
+        if s.name in STAGES
+    }
+
+
+def compare_to_baseline(results: Dict, baseline: Dict, threshold: float) -> List[str]:
+    regressions = []
+    for case, stages in results.items():
+        for stage, measured in stages.items():
+            expected = baseline.get(case, {}).get(stage)
+            if not expected:
+                continue
+            for metric in ("seconds", "peak_bytes"):
+                if expected[metric] and measured[metric] > expected[metric] * threshold:
+                    regressions.append(
+                        f"{case} {stage} {metric}: "
+                        f"{measured[metric]:.4g} > {expected[metric]:.4g}"
+                    )
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark KeePassDiff stages")
+    parser.add_argument("--entries", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--overlap", type=float, default=0.8)
+    parser.add_argument("--changed", type=float, default=0.1)
+    parser.add_argument("--attachment-ratio", type=float, default=0.0)
+    parser.add_argument("--attachment-size", type=int, default=4096)
+    parser.add_argument("--argon2-iterations", type=int, default=1)
+    parser.add_argument("--argon2-memory", type=int, default=1024 * 1024)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.25,
+        help="ratio over the baseline reported as a regression",
+    )
+    args = parser.parse_args(argv)
+
+    results = {}
+    for entries in args.entries:
+        with tempfile.TemporaryDirectory() as directory:
+            case = f"{entries}_entries"
+            results[case] = run_case(
+                directory,
+                entries,
+                depth=args.depth,
+                overlap=args.overlap,
+                changed=args.changed,
+                attachment_ratio=args.attachment_ratio,
+                attachment_size=args.attachment_size,
+                kdf={"I": args.argon2_iterations, "M": args.argon2_memory, "P": 1},
+                seed=args.seed,
+            )
+        for stage, measured in results[case].items():
+            print(
+                f"{case:>16} {stage:>10} {measured['seconds'] * 1000:10.1f} ms "
+                f"{measured['peak_bytes'] / 1024 / 1024:10.2f} MiB"
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f"regression: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
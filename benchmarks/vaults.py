@@ -0,0 +1,118 @@
+import os
+import random
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from pykeepass import create_database
+from pykeepass.entry import Entry
+
+# Argon2 settings used when no KDF parameters are given. Deliberately cheap so
+# the benchmark measures KeePassDiff rather than the KDF.
+FAST_KDF = {"I": 1, "M": 1024 * 1024, "P": 1}
+
+
+def _set_kdf(kp, kdf: Dict[str, int]):
+    header = kp.kdbx.header
+    parameters = header.value.dynamic_header.kdf_parameters.data.dict
+    for name, value in kdf.items():
+        parameters[name].value = value
+    # Before 4.2 pykeepass writes the header bytes as parsed while they are
+    # kept, which would save the old KDF parameters
+    header.pop("data", None)
+
+
+def _group_paths(rng: random.Random, count: int, depth: int) -> List[Tuple[str, ...]]:
+    paths = [()]
+    while len(paths) < count:
+        parent = rng.choice([p for p in paths if len(p) < depth] or [()])
+        paths.append(parent + (f"group{len(paths)}",))
+    return paths
+
+
+def generate_vault_pair(
+    directory: str,
+    entries: int = 1000,
+    depth: int = 3,
+    groups: Optional[int] = None,
+    overlap: float = 0.8,
+    changed: float = 0.1,
+    attachment_ratio: float = 0.0,
+    attachment_size: int = 4096,
+    kdf: Optional[Dict[str, int]] = None,
+    password: str = "benchmark",
+    seed: int = 0,
+) -> Tuple[str, str]:
+    # Writes a.kdbx and b.kdbx with `entries` entries each. `overlap` of them
+    # exist in both with the same UUID, `changed` of those shared have another
+    # password in b.kdbx, and `attachment_ratio` of all entries carry an
+    # attachment of `attachment_size` random bytes.
+    rng = random.Random(seed)
+    group_paths = _group_paths(rng, groups or max(1, entries // 50), depth)
+
+    shared = int(entries * overlap)
+    specs = []
+    for i in range(shared + 2 * (entries - shared)):
+        specs.append(
+            {
+                "uuid": uuid.UUID(int=rng.getrandbits(128)),
+                "group": rng.choice(group_paths),
+                "title": f"entry{i}",
+                "username": f"user{rng.randrange(entries)}",
+                "password": "%032x" % rng.getrandbits(128),
+                "url": f"https://site{rng.randrange(entries)}.example/",
+                "notes": "note " * rng.randrange(10),
+                "attachment": (
+                    rng.randbytes(attachment_size)
+                    if rng.random() < attachment_ratio
+                    else None
+                ),
+            }
+        )
+
+    db1_specs = specs[:shared] + specs[shared : shared + entries - shared]
+    db2_specs = [
+        (
+            dict(spec, password="changed" + spec["password"])
+            if rng.random() < changed
+            else spec
+        )
+        for spec in specs[:shared]
+    ] + specs[shared + entries - shared :]
+
+    paths = []
+    for name, db_specs in (("a.kdbx", db1_specs), ("b.kdbx", db2_specs)):
+        path = os.path.join(directory, name)
+        _write_vault(path, password, db_specs, kdf or FAST_KDF)
+        paths.append(path)
+    return paths[0], paths[1]
+
+
+def _write_vault(path: str, password: str, specs: List[Dict], kdf: Dict[str, int]):
+    kp = create_database(path, password=password)
+    _set_kdf(kp, kdf)
+
+    created = {(): kp.root_group}
+
+    def group_for(group_path):
+        if group_path not in created:
+            parent = group_for(group_path[:-1])
+            created[group_path] = kp.add_group(parent, group_path[-1])
+        return created[group_path]
+
+    for spec in specs:
+        # Appending directly skips add_entry's per-entry duplicate search
+        entry = Entry(
+            title=spec["title"],
+            username=spec["username"],
+            password=spec["password"],
+            url=spec["url"],
+            notes=spec["notes"],
+            kp=kp,
+        )
+        entry.uuid = spec["uuid"]
+        group_for(spec["group"]).append(entry)
+        if spec["attachment"] is not None:
+            binary_id = kp.add_binary(spec["attachment"])
+            entry.add_attachment(binary_id, "attachment.bin")
+
+    kp.save()
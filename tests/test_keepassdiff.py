@@ -1,15 +1,46 @@
+import json
 import os
 import pytest
 from pykeepass import PyKeePass, create_database
 from KeePassDiff.utils.database import (
+    DatabaseCache,
     get_entries_set,
+    index_database,
+    export_database,
+    merge_entries,
     merge_entry,
+    merge_group,
+    open_database_bytes,
     save_temp_database,
     get_entry_details,
 )
-from KeePassDiff.utils.comparison import compare_databases
-from io import BytesIO
+from benchmarks.vaults import generate_vault_pair
+from KeePassDiff import cli
+from KeePassDiff.utils.comparison import (
+    compare_databases,
+    compare_many,
+    find_similar_entries,
+)
+from KeePassDiff.utils import profiling
+from KeePassDiff.utils.batch import run_jobs
+from KeePassDiff.utils.listing import PathListing, page_slice
+from KeePassDiff.utils import snapshot as snapshot_module
+from KeePassDiff.utils.snapshot import (
+    EntrySnapshot,
+    decode_time,
+    hash_binaries,
+    history_changes,
+    snapshot_database,
+    snapshot_entry,
+)
+from KeePassDiff.utils.threeway import merge_three_way
+from KeePassDiff.utils.unlock import UnlockRequest, unlock_cached, unlock_databases
+from KeePassDiff.utils.watch import VaultWatcher
+from datetime import datetime, timedelta, timezone
+from io import BytesIO, StringIO
+import shutil
 import tempfile
+import time
 
 
 @pytest.fixture
@@ -161,3 +192,881 @@ def test_diff_and_merge_on_programmatic_db():
     # Test merge
     assert merge_entry(kp2, kp1, "c")
     assert any(entry.title == "c" for entry in kp1.entries)
+
+
+def test_unlock_cached_reuses_and_evicts():
+    db_file_path = create_sample_db(entries=[{"title": "foo"}])
+    cache = DatabaseCache()
+
+    kp = unlock_cached(cache, {"db1": (db_file_path, "test", None)})["db1"].kp
+    again = unlock_cached(cache, {"db1": (db_file_path, "test", None)})["db1"]
+    assert again.kp is kp
+
+    # Changed upload replaces the slot
+    other_path = create_sample_db(entries=[{"title": "bar"}])
+    other = unlock_cached(cache, {"db1": (other_path, "test", None)})["db1"].kp
+    assert other is not kp
+    assert cache.get("db1", "stale") is None
+
+    cache.evict("db1")
+    assert "db1" not in cache
+
+
+def test_index_lookup_and_merge_into_nested_group():
+    db1_path = create_sample_db(entries=[{"title": "a", "group": "work"}])
+    db2_path = create_sample_db(entries=[{"title": "b", "group": "work"}])
+    kp1 = PyKeePass(db1_path, password="test")
+    kp2 = PyKeePass(db2_path, password="test")
+    index1 = index_database(kp1)
+    index2 = index_database(kp2)
+
+    assert index1.as_sets() == get_entries_set(kp1)
+    entry = index1.entries["work/a"]
+    assert index1.entries_by_uuid[entry.uuid] is entry
+    assert get_entry_details(kp1, "work/a", index1)["path"] == "work"
+
+    assert merge_entry(kp1, kp2, "work/a", index1, index2)
+    # Existing group is reused and the target index sees the new entry
+    assert len([g for g in kp2.groups if g.name == "work"]) == 1
+    assert "work/a" in index2.entries
+    assert index_database(kp2).as_sets() == index2.as_sets()
+
+
+def test_compare_contents_splits_common_and_detects_moves():
+    db1_path = create_sample_db(
+        entries=[{"title": "same"}, {"title": "edited"}, {"title": "moved"}]
+    )
+    db2_path = db1_path + ".copy.kdbx"
+    shutil.copy(db1_path, db2_path)
+    kp1 = PyKeePass(db1_path, password="test")
+    kp2 = PyKeePass(db2_path, password="test")
+
+    edited = kp2.find_entries(title="edited", first=True)
+    edited.password = "changed"
+    kp2.move_entry(
+        kp2.find_entries(title="moved", first=True),
+        kp2.add_group(kp2.root_group, "archive"),
+    )
+
+    differences = compare_databases(
+        get_entries_set(kp1),
+        get_entries_set(kp2),
+        snapshot_database(kp1),
+        snapshot_database(kp2),
+    )
+
+    assert differences["identical_entries"] == ["same"]
+    assert differences["changed_entries"] == ["edited"]
+    assert "password" in differences["field_deltas"]["edited"]
+    assert differences["moved_entries"] == [("moved", "archive/moved")]
+    assert differences["entries_only_in_db1"] == []
+    assert differences["entries_only_in_db2"] == []
+
+
+def test_diff_result_applies_merges_without_recomparing():
+    db1_path = create_sample_db(
+        entries=[{"title": "a", "group": "work/vpn"}, {"title": "b"}, {"title": "c"}]
+    )
+    db2_path = create_sample_db(entries=[{"title": "c"}])
+    kp1 = PyKeePass(db1_path, password="test")
+    kp2 = PyKeePass(db2_path, password="test")
+    index1 = index_database(kp1)
+    index2 = index_database(kp2)
+    differences = compare_databases(
+        index1.as_sets(),
+        index2.as_sets(),
+        snapshot_database(kp1),
+        snapshot_database(kp2),
+    )
+
+    merged = merge_entries(kp1, kp2, ["work/vpn/a", "b"], index1, index2, save=False)
+    for entry_path in merged:
+        target_snapshot = snapshot_entry(index2.entries[entry_path], entry_path)
+        assert differences.apply_merge(entry_path, 1, target_snapshot)
+    assert not differences.apply_merge("b", 1)
+
+    expected = compare_databases(
+        get_entries_set(kp1),
+        get_entries_set(kp2),
+        snapshot_database(kp1),
+        snapshot_database(kp2),
+    )
+    assert dict(differences) == dict(expected)
+    assert differences["group_tree"] == expected["group_tree"]
+    assert differences["entries_only_in_db1"] == []
+    assert "work/vpn" in differences["common_groups"]
+
+
+def test_snapshot_database_reads_the_tree_like_pykeepass():
+    db_path = create_sample_db()
+    kp = PyKeePass(db_path, password="test")
+    vpn = kp.add_group(kp.add_group(kp.root_group, "work"), "vpn")
+    first = kp.add_entry(vpn, "a", "u", "p", url="https://a.example")
+    first.set_custom_property("otp-seed", "123")
+    first.add_attachment(kp.add_binary(b"secret"), "key.pem")
+    kp.add_entry(vpn, "b", "u", "p")
+    # Saving a history copy must not add a second "work/vpn/a"
+    first.save_history()
+    first.password = "new"
+    kp.save()
+    kp = PyKeePass(db_path, password="test")
+
+    snapshots = snapshot_database(kp)
+    index = index_database(kp)
+    assert set(snapshots) == set(index.entries) == {"work/vpn/a", "work/vpn/b"}
+    for entry_path, entry in index.entries.items():
+        snapshot = snapshots[entry_path]
+        assert snapshot == snapshot_entry(entry, entry_path)
+        assert snapshot.uuid == entry.uuid
+        assert (snapshot.title, snapshot.mtime) == (entry.title, entry.mtime)
+    a, b = snapshots["work/vpn/a"], snapshots["work/vpn/b"]
+    assert a.group == ("work", "vpn") and a.group is b.group
+    assert {"string:otp-seed", "attachment:key.pem"} <= a.fields.keys()
+
+    # KDBX4 and KDBX3 encodings of one time decode to the same value
+    assert decode_time("AAAAAAAAAAA=", True) == datetime(1, 1, 1, tzinfo=timezone.utc)
+    assert decode_time("2024-05-01T10:00:00Z", False) == decode_time(
+        "2024-05-01T10:00:00Z", True
+    )
+
+
+def test_diff_covers_attachments_and_history_hashing_each_binary_once(monkeypatch):
+    db_path = create_sample_db(entries=[{"title": "a"}, {"title": "b"}])
+    kp = PyKeePass(db_path, password="test")
+    certificate = kp.add_binary(b"certificate" * 1000)
+    for entry in kp.entries:
+        entry.add_attachment(certificate, "ca.pem")
+    kp.save()
+    kp1 = PyKeePass(db_path, password="test")
+    kp2 = PyKeePass(db_path, password="test")
+
+    a = kp2.find_entries(title="a", first=True)
+    a.save_history()
+    b = kp2.find_entries(title="b", first=True)
+    b.delete_attachment(b.attachments[0])
+    b.add_attachment(kp2.add_binary(b"renewed"), "ca.pem")
+
+    hashed = []
+    hash_stored = snapshot_module._hash_stored
+    monkeypatch.setattr(
+        snapshot_module,
+        "_hash_stored",
+        lambda stored: hashed.append(stored) or hash_stored(stored),
+    )
+    differences = compare_databases(
+        get_entries_set(kp1),
+        get_entries_set(kp2),
+        snapshot_database(kp1),
+        snapshot_database(kp2),
+    )
+    # One shared blob in the first database, two in the second
+    assert len(hashed) == 3
+    assert differences["field_deltas"] == {
+        "a": ["history"],
+        "b": ["attachment:ca.pem"],
+    }
+    assert history_changes(*(differences.snapshots[i]["a"] for i in (1, 2))) == (
+        0,
+        1,
+    )
+    assert get_entry_details(kp2, "a")["attachments"] == ["ca.pem"]
+    assert get_entry_details(kp2, "a")["history"] == 1
+
+    # Later snapshots only hash binaries added since
+    kp2.add_binary(b"another")
+    assert len(hash_binaries(kp2)) == 3
+    assert snapshot_entry(a, "a") == snapshot_database(kp2)["a"]
+    assert len(hashed) == 4
+
+
+def test_similar_entries_pair_recreated_entries_within_blocks():
+    db1_path = create_sample_db()
+    db2_path = create_sample_db()
+    kp1 = PyKeePass(db1_path, password="test")
+    kp2 = PyKeePass(db2_path, password="test")
+    kp1.add_entry(kp1.root_group, "GitHub", "alice", "p1", "https://github.com/login")
+    kp1.add_entry(kp1.root_group, "Bank", "bob", "p2", "bank.example")
+    dev = kp2.add_group(kp2.root_group, "dev")
+    kp2.add_entry(dev, "github.com", "alice", "p1", "https://www.github.com")
+    kp2.add_entry(kp2.root_group, "Bank account", "bob", "p3", "https://bank.example/x")
+    for i in range(5):
+        kp2.add_entry(kp2.root_group, f"shared {i}", "alice", f"q{i}")
+
+    snapshots1, snapshots2 = snapshot_database(kp1), snapshot_database(kp2)
+    differences = compare_databases(
+        get_entries_set(kp1), get_entries_set(kp2), snapshots1, snapshots2
+    )
+    # Only the GitHub entry is alike enough, and it stays exclusive
+    [(old_path, new_path, score)] = differences["similar_entries"]
+    assert (old_path, new_path) == ("GitHub", "dev/github.com") and score > 0.6
+    assert "GitHub" in differences["entries_only_in_db1"]
+
+    # The "alice" block is too large, the host block still finds the pair
+    found = find_similar_entries(
+        [snapshots1["GitHub"]], list(snapshots2.values()), max_block=3
+    )
+    assert [pair[:2] for pair in found] == [("GitHub", "dev/github.com")]
+    found = find_similar_entries(
+        [snapshots1["Bank"]], list(snapshots2.values()), min_score=0, max_block=3
+    )
+    assert [pair[:2] for pair in found] == [("Bank", "Bank account")]
+
+
+def test_group_tree_diff_skips_identical_subtrees_and_finds_moves():
+    db1_path = create_sample_db(
+        entries=[
+            {"title": "vpn", "group": "work"},
+            {"title": "bank", "group": "personal"},
+            {"title": "wifi", "group": "shared"},
+        ],
+        groups=["archive"],
+    )
+    db2_path = db1_path + ".copy.kdbx"
+    shutil.copy(db1_path, db2_path)
+    kp1 = PyKeePass(db1_path, password="test")
+    kp2 = PyKeePass(db2_path, password="test")
+    kp2.move_group(
+        kp2.find_groups(name="work", first=True),
+        kp2.find_groups(name="archive", first=True),
+    )
+    kp2.add_entry(kp2.add_group(kp2.root_group, "new"), "mail", "u", "p")
+    kp2.find_entries(title="wifi", first=True).password = "changed"
+
+    differences = compare_databases(
+        get_entries_set(kp1),
+        get_entries_set(kp2),
+        snapshot_database(kp1),
+        snapshot_database(kp2),
+    )
+    assert differences["groups_only_in_db2"] == ["archive/work", "new"]
+
+    group_tree = differences["group_tree"]
+    assert group_tree["groups_moved"] == [("work", "archive/work")]
+    assert group_tree["groups_added"] == ["new"]
+    assert group_tree["groups_removed"] == []
+    assert group_tree["groups_changed"] == ["", "archive", "shared"]
+    # Only "personal" is skipped at the top level
+    assert group_tree["identical_subtrees"] == 1
+
+
+@pytest.mark.parametrize("preserve_uuids", [False, True])
+def test_merge_group_copies_subtree_with_attachments(preserve_uuids):
+    db1_path = create_sample_db(entries=[{"title": "shared"}])
+    kp1 = PyKeePass(db1_path, password="test")
+    work = kp1.add_group(kp1.root_group, "work")
+    vpn = kp1.add_group(work, "vpn")
+    kp1.add_group(work, "empty")
+    entry = kp1.add_entry(vpn, "gateway", "u", "p")
+    entry.set_custom_property("port", "443")
+    entry.add_attachment(kp1.add_binary(b"certificate"), "ca.pem")
+    entry.save_history()
+    entry.password = "rotated"
+    kp1.add_entry(work, "mail", "u", "p")
+    kp1.save()
+    kp1 = PyKeePass(db1_path, password="test")
+    kp2 = PyKeePass(create_sample_db(entries=[{"title": "shared"}]), password="test")
+    kp2.add_binary(b"other")
+
+    index1 = index_database(kp1)
+    index2 = index_database(kp2)
+    differences = compare_databases(
+        index1.as_sets(),
+        index2.as_sets(),
+        snapshot_database(kp1),
+        snapshot_database(kp2),
+    )
+    copied = merge_group(
+        kp1, kp2, "work", index1, index2, preserve_uuids=preserve_uuids, save=False
+    )
+    assert sorted(copied) == ["work/mail", "work/vpn/gateway"]
+    assert merge_group(kp1, kp2, "work", index1, index2, save=False) == []
+
+    kp2 = open_database_bytes(export_database(kp2), "test")
+    merged = kp2.find_entries(title="gateway", first=True)
+    assert merged.attachments[0].data == b"certificate"
+    assert merged.get_custom_property("port") == "443"
+    assert [old.password for old in merged.history] == ["p"]
+    assert (merged.uuid == entry.uuid) == preserve_uuids
+    assert merged.history[0].uuid == merged.uuid
+    assert index_database(kp2).as_sets() == index2.as_sets()
+    assert "work/empty" in index2.groups
+
+    snapshots = {path: snapshot_entry(index2.entries[path], path) for path in copied}
+    assert differences.apply_group_merge("work", 1, snapshots)
+    assert differences["groups_only_in_db1"] == []
+    assert differences["entries_only_in_db1"] == []
+    # Every field, times included, came along
+    assert set(copied) <= set(differences["identical_entries"])
+
+
+@pytest.mark.parametrize("use_processes", [False, True])
+def test_unlock_databases_reports_errors_per_database(use_processes):
+    sample_dir = os.path.join(os.path.dirname(__file__), "sample_databases")
+    with open(os.path.join(sample_dir, "a.kdbx"), "rb") as f:
+        a_bytes = f.read()
+    with open(os.path.join(sample_dir, "b.kdbx"), "rb") as f:
+        b_bytes = f.read()
+
+    unlocked = []
+    results = unlock_databases(
+        [
+            UnlockRequest("a", a_bytes, "asdf"),
+            UnlockRequest("b", b_bytes, "wrong"),
+        ],
+        use_processes=use_processes,
+        on_unlocked=lambda result: unlocked.append(result.name),
+    )
+
+    assert sorted(unlocked) == ["a", "b"]
+    assert [r.name for r in results] == ["a", "b"]
+    assert get_entries_set(results[0].kp)["entries"] == {"a", "b"}
+    assert results[1].kp is None and results[1].error is not None
+
+
+def test_unlock_cached_skips_cached_slots():
+    db_file_path = create_sample_db(entries=[{"title": "foo"}])
+    cache = DatabaseCache()
+
+    first = unlock_cached(cache, {"db1": (db_file_path, "test", None)})
+    unlocked = []
+    again = unlock_cached(
+        cache,
+        {"db1": (db_file_path, "test", None)},
+        on_unlocked=lambda result: unlocked.append(result.name),
+    )
+
+    assert unlocked == []
+    assert again["db1"].kp is first["db1"].kp
+
+
+def test_unlock_cached_reuses_key_for_saves_and_new_uploads():
+    db_file_path = create_sample_db(entries=[{"title": "foo"}])
+    now = [0.0]
+    cache = DatabaseCache(idle_timeout=60, clock=lambda: now[0])
+    profiler = profiling.Profiler(trace_memory=False)
+
+    with profiler.activate():
+        first = unlock_cached(cache, {"db1": (db_file_path, "test", None)})["db1"]
+        # An export saved with the key keeps the KDF salt, so uploading it again
+        # opens with the held key
+        exported = export_database(first.kp, first.transformed_key)
+        again = unlock_cached(cache, {"db1": (BytesIO(exported), "test", None)})
+    assert [span.name for span in profiler.spans].count("kdf") == 1
+    assert again["db1"].kp is not first.kp
+    assert again["db1"].transformed_key == first.transformed_key
+    assert open_database_bytes(exported, "test").entries[0].title == "foo"
+
+    # A key that no longer fits is derived again
+    stale = UnlockRequest("db1", exported, "test", None, bytes(32))
+    assert unlock_databases([stale])[0].transformed_key == first.transformed_key
+
+    # Other credentials wipe the held key
+    assert cache.get_key("db1", "other") is None
+    assert cache.get_key("db1", None) is None
+
+    cache.put_key("db1", "digest", first.transformed_key)
+    now[0] = 61
+    assert cache.expire() == ["db1"]
+    assert "db1" not in cache and cache.get_key("db1", "digest") is None
+
+
+def test_database_cache_touch_keeps_open_databases_alive():
+    now = [0.0]
+    cache = DatabaseCache(idle_timeout=60, clock=lambda: now[0])
+    cache.put("db1", "digest", object())
+
+    now[0] = 50
+    assert cache.touch("db1")
+    assert not cache.touch("db1", "db2")
+    now[0] = 100
+    assert cache.expire() == []
+    now[0] = 200
+    assert not cache.touch("db1")
+    assert cache.expire() == ["db1"]
+
+
+def test_vault_watcher_reopens_only_changed_copies(monkeypatch, capsys, tmp_path):
+    db_file_path = create_sample_db(entries=[{"title": "foo"}])
+    laptop, phone = str(tmp_path / "laptop.kdbx"), str(tmp_path / "phone.kdbx")
+    shutil.copy(db_file_path, laptop)
+    shutil.copy(db_file_path, phone)
+    watcher = VaultWatcher(str(tmp_path), "test")
+
+    events = watcher.scan()
+    assert [e["event"] for e in events] == ["added", "added", "summary"]
+    assert events[-1]["identical"] == 1
+
+    # Touching a file without changing it reopens nothing
+    os.utime(phone, ns=(0, 0))
+    assert watcher.scan() == []
+
+    # Saved with the same key, the change is opened without the KDF
+    kp = PyKeePass(phone, password="test")
+    kp.add_entry(kp.root_group, "bar", "u", "p")
+    kp.save(transformed_key=kp.transformed_key)
+    profiler = profiling.Profiler(trace_memory=False)
+    with profiler.activate():
+        events = watcher.scan()
+    assert [span.name for span in profiler.spans].count("kdf") == 0
+    assert events[0] == {
+        "event": "changed",
+        "database": phone,
+        "entries_added": ["bar"],
+        "entries_removed": [],
+        "entries_changed": [],
+    }
+    assert events[-1]["entries"] == 2 and events[-1]["in_all"] == 1
+
+    os.remove(laptop)
+    events = watcher.scan()
+    assert events[0] == {"event": "removed", "database": laptop}
+    assert events[-1]["databases"] == [phone]
+
+    monkeypatch.setenv("KPD_PASSWORD", "test")
+    assert cli.main(["watch", str(tmp_path), "--once", "--summary"]) == 0
+    events = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [e["event"] for e in events] == ["summary"]
+
+
+def test_vault_watcher_retries_failed_copies_only_once_changed(tmp_path):
+    db_file_path = create_sample_db(entries=[{"title": "foo"}, {"title": "bar"}])
+    laptop, phone = str(tmp_path / "laptop.kdbx"), str(tmp_path / "phone.kdbx")
+    shutil.copy(db_file_path, laptop)
+    shutil.copy(db_file_path, phone)
+    stray = str(tmp_path / "stray.kdbx")
+    shutil.copy(create_sample_db(password="other"), stray)
+    watcher = VaultWatcher(str(tmp_path), "test")
+
+    events = watcher.scan()
+    assert sorted(e["event"] for e in events) == ["added", "added", "error", "summary"]
+
+    # An unchanged copy that failed is not opened again, touched or not
+    os.utime(stray, ns=(0, 0))
+    profiler = profiling.Profiler(trace_memory=False)
+    with profiler.activate():
+        assert watcher.scan() == []
+    assert [span.name for span in profiler.spans].count("kdf") == 0
+
+    # Once its content changes it is tried again
+    kp = PyKeePass(stray, password="other")
+    kp.add_entry(kp.root_group, "baz", "u", "p")
+    kp.save()
+    assert [e["event"] for e in watcher.scan()] == ["error", "summary"]
+
+    kp = PyKeePass(phone, password="test")
+    kp.find_entries(title="foo", first=True).password = "changed"
+    kp.add_entry(kp.root_group, "baz", "u", "p")
+    kp.save()
+    summary = watcher.scan()[-1]
+    assert summary["databases"] == [laptop, phone]
+    snapshots = [watcher.files[path].snapshots for path in (laptop, phone)]
+    expected = compare_many(snapshots, [laptop, phone])["summary"]
+    assert {key: summary[key] for key in expected} == expected
+    assert expected == {"entries": 3, "in_all": 2, "identical": 1, "diverged": 1}
+
+
+def test_merged_entries_are_identical_to_their_source():
+    db1_path = create_sample_db(entries=[{"title": "a", "group": "work"}])
+    db2_path = create_sample_db()
+    kp1 = PyKeePass(db1_path, password="test")
+    kp2 = PyKeePass(db2_path, password="test")
+    entry = kp1.find_entries(title="a", first=True)
+    entry.set_custom_property("otp-seed", "123")
+    entry.add_attachment(kp1.add_binary(b"secret"), "key.pem")
+    entry.save_history()
+    index1, index2 = index_database(kp1), index_database(kp2)
+    differences = compare_databases(
+        index1.as_sets(),
+        index2.as_sets(),
+        snapshot_database(kp1),
+        snapshot_database(kp2),
+    )
+
+    assert merge_entries(kp1, kp2, ["work/a"], index1, index2, save=False) == ["work/a"]
+    differences.apply_merge(
+        "work/a", 1, snapshot_entry(index2.entries["work/a"], "work/a")
+    )
+    assert differences["identical_entries"] == ["work/a"]
+    assert differences["changed_entries"] == []
+
+    merged = open_database_bytes(export_database(kp2), "test").entries[0]
+    assert merged.mtime == entry.mtime and merged.ctime == entry.ctime
+    assert merged.get_custom_property("otp-seed") == "123"
+    assert merged.attachments[0].data == b"secret"
+    assert merged.uuid != entry.uuid
+
+
+def test_merge_entries_creates_groups_once_and_saves_once(monkeypatch):
+    db1_path = create_sample_db(
+        entries=[
+            {"title": "a", "group": "shared"},
+            {"title": "b", "group": "shared"},
+            {"title": "c"},
+        ]
+    )
+    db2_path = create_sample_db()
+    kp1 = PyKeePass(db1_path, password="test")
+    kp2 = PyKeePass(db2_path, password="test")
+
+    saves = []
+    monkeypatch.setattr(kp2, "save", lambda *args, **kwargs: saves.append(args))
+    merged = merge_entries(kp1, kp2, ["shared/a", "shared/b", "c", "missing"])
+
+    assert merged == ["shared/a", "shared/b", "c"]
+    assert len(saves) == 1
+    assert len([g for g in kp2.groups if g.name == "shared"]) == 1
+    assert get_entries_set(kp2)["entries"] == {"shared/a", "shared/b", "c"}
+
+
+def test_cli_diff_and_merge(monkeypatch, capsys, tmp_path):
+    sample_dir = os.path.join(os.path.dirname(__file__), "sample_databases")
+    db1_path = os.path.join(sample_dir, "a.kdbx")
+    db2_path = os.path.join(sample_dir, "b.kdbx")
+    monkeypatch.setenv("KPD_PASSWORD", "asdf")
+
+    assert cli.main(["diff", db1_path, db2_path]) == 1
+    events = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert {"event": "entry_only", "db": 2, "path": "c"} in events
+    assert events[-1]["event"] == "summary"
+    assert events[-1]["entries_only_in_db2"] == 1
+
+    output = str(tmp_path / "merged.kdbx")
+    assert cli.main(["merge", db1_path, db2_path, "-o", output]) == 0
+    assert "c" in get_entries_set(PyKeePass(output, password="asdf"))["entries"]
+
+
+def test_cli_newest_policy_takes_the_whole_newer_entry(monkeypatch, tmp_path):
+    db1_path = create_sample_db(entries=[{"title": "a"}, {"title": "b"}])
+    db2_path = str(tmp_path / "db2.kdbx")
+    shutil.copy(db1_path, db2_path)
+    kp2 = PyKeePass(db2_path, password="test")
+    later = datetime.now(timezone.utc) + timedelta(days=1)
+    a = kp2.find_entries(title="a", first=True)
+    a.set_custom_property("seed", "new")
+    a.mtime = later
+    b = kp2.find_entries(title="b", first=True)
+    b.add_attachment(kp2.add_binary(b"certificate"), "ca.pem")
+    b.mtime = later
+    kp2.save()
+
+    monkeypatch.setenv("KPD_PASSWORD", "test")
+    output = str(tmp_path / "merged.kdbx")
+    args = ["merge", db1_path, db2_path, "--policy", "newest", "-o", output]
+    assert cli.main(args) == 0
+    merged = PyKeePass(output, password="test")
+    kp1 = PyKeePass(db1_path, password="test")
+    entries = {entry.title: entry for entry in merged.entries}
+    assert entries["a"].get_custom_property("seed") == "new"
+    assert entries["b"].attachments[0].data == b"certificate"
+    assert entries["a"].uuid == kp1.find_entries(title="a", first=True).uuid
+    assert [len(entries[title].history) for title in "ab"] == [1, 1]
+    assert not entries["a"].history[0].get_custom_property("seed")
+
+
+def test_three_way_merge_resolves_one_sided_changes(capsys, monkeypatch, tmp_path):
+    base_path = create_sample_db(
+        entries=[{"title": t} for t in ("a", "b", "c", "d", "e")]
+    )
+    left_path, right_path = str(tmp_path / "left.kdbx"), str(tmp_path / "right.kdbx")
+    shutil.copy(base_path, left_path)
+    shutil.copy(base_path, right_path)
+
+    left = PyKeePass(left_path, password="test")
+    left.find_entries(title="a", first=True).username = "left-user"
+    left.find_entries(title="b", first=True).password = "left"
+    left.delete_entry(left.find_entries(title="d", first=True))
+    left.save()
+
+    right = PyKeePass(right_path, password="test")
+    a = right.find_entries(title="a", first=True)
+    a.save_history()
+    a.password = "right"
+    right.find_entries(title="b", first=True).password = "right"
+    c = right.find_entries(title="c", first=True)
+    right.move_entry(c, right.add_group(right.root_group, "moved"))
+    c.url = "https://c.example"
+    c.add_attachment(right.add_binary(b"certificate"), "ca.pem")
+    right.delete_entry(right.find_entries(title="e", first=True))
+    right.add_entry(right.root_group, "f", "u", "p")
+    right.save()
+
+    kp = PyKeePass(left_path, password="test")
+    plan = merge_three_way(
+        PyKeePass(base_path, password="test"),
+        kp,
+        PyKeePass(right_path, password="test"),
+        save=False,
+    )
+    assert plan["updated"] == [
+        ("a", "a", ["history", "password"]),
+        ("c", "moved/c", ["attachment:ca.pem", "group", "url"]),
+    ]
+    assert plan["conflicts"] == [{"path": "b", "fields": ["password"]}]
+    assert (plan["added"], plan["deleted"]) == (["f"], ["e"])
+
+    merged = open_database_bytes(export_database(kp), "test")
+    entries = {entry.title: entry for entry in merged.entries}
+    assert sorted(entries) == ["a", "b", "c", "f"]
+    assert (entries["a"].username, entries["a"].password) == ("left-user", "right")
+    assert len(entries["a"].history) == 1
+    assert entries["b"].password == "left"
+    assert entries["c"].path == ["moved", "c"]
+    assert entries["c"].attachments[0].data == b"certificate"
+
+    monkeypatch.setenv("KPD_PASSWORD", "test")
+    output = str(tmp_path / "merged.kdbx")
+    args = ["merge", left_path, right_path, "--base", base_path, "-o", output]
+    assert cli.main(args) == 1
+    events = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert {"event": "conflict", "path": "b", "fields": ["password"]} in events
+    assert events[-1]["updated"] == 2
+    assert {entry.title for entry in PyKeePass(output, password="test").entries} == {
+        "a",
+        "b",
+        "c",
+        "f",
+    }
+
+
+def test_three_way_merge_matches_duplicate_titles_by_uuid(tmp_path):
+    base_path = create_sample_db(
+        entries=[
+            {"title": "login", "group": "work", "username": "alice"},
+            {"title": "login", "group": "work", "username": "bob"},
+        ]
+    )
+    left_path, right_path = str(tmp_path / "left.kdbx"), str(tmp_path / "right.kdbx")
+    shutil.copy(base_path, left_path)
+    shutil.copy(base_path, right_path)
+
+    # Only the order of the entries changed on the right
+    right = PyKeePass(right_path, password="test")
+    group = right.find_groups(name="work", first=True)._element
+    first = group.find("Entry")
+    group.remove(first)
+    group.append(first)
+    right.save()
+    kp = PyKeePass(left_path, password="test")
+    plan = merge_three_way(
+        PyKeePass(base_path, password="test"),
+        kp,
+        PyKeePass(right_path, password="test"),
+        save=False,
+    )
+    assert plan == {"updated": [], "added": [], "deleted": [], "conflicts": []}
+
+    # Both entries added under one title are merged
+    work = right.find_groups(name="work", first=True)
+    right.add_entry(work, "new", "carol", "p")
+    right.add_entry(work, "new", "dave", "p")
+    right.save()
+    plan = merge_three_way(
+        PyKeePass(base_path, password="test"),
+        kp,
+        PyKeePass(right_path, password="test"),
+        save=False,
+    )
+    assert plan["added"] == ["work/new", "work/new"]
+
+    merged = open_database_bytes(export_database(kp), "test")
+    assert sorted((entry.title, entry.username) for entry in merged.entries) == [
+        ("login", "alice"),
+        ("login", "bob"),
+        ("new", "carol"),
+        ("new", "dave"),
+    ]
+
+
+def test_cli_batch_streams_results_and_summary(monkeypatch, capsys, tmp_path):
+    sample_dir = os.path.join(os.path.dirname(__file__), "sample_databases")
+    shutil.copy(os.path.join(sample_dir, "a.kdbx"), tmp_path / "a.kdbx")
+    shutil.copy(os.path.join(sample_dir, "b.kdbx"), tmp_path / "b.kdbx")
+    (tmp_path / "password").write_text("asdf\n")
+    jobs = [
+        {"name": "differs", "databases": ["a.kdbx", "b.kdbx"]},
+        {
+            "name": "same",
+            "databases": ["a.kdbx", "a.kdbx"],
+            "password_file": "password",
+        },
+        {"name": "missing", "databases": ["a.kdbx", "gone.kdbx"]},
+    ]
+    manifest = tmp_path / "manifest.jsonl"
+    manifest.write_text("\n".join(json.dumps(job) for job in jobs))
+    monkeypatch.setenv("KPD_PASSWORD", "asdf")
+
+    assert cli.main(["batch", str(manifest), "--workers", "2"]) == 2
+    out, err = capsys.readouterr()
+    events = {e.get("job", "all"): e for e in map(json.loads, out.splitlines())}
+    assert events["differs"]["differs"]
+    assert events["differs"]["entries_only_in_db2"] == 1
+    assert not events["same"]["differs"]
+    assert json.loads(err)["job"] == "missing"
+    summary = events["all"]
+    assert (summary["identical"], summary["differing"], summary["failed"]) == (1, 1, 1)
+    assert summary["totals"]["entries_only_in_db2"] == 1
+
+
+def test_cli_batch_prefers_job_passwords_to_stdin(monkeypatch, capsys, tmp_path):
+    sample_dir = os.path.join(os.path.dirname(__file__), "sample_databases")
+    shutil.copy(os.path.join(sample_dir, "a.kdbx"), tmp_path / "a.kdbx")
+    (tmp_path / "password").write_text("asdf\n")
+    jobs = [
+        {"name": "own", "databases": ["a.kdbx", "a.kdbx"], "password_file": "password"},
+        {"name": "stdin", "databases": ["a.kdbx", "a.kdbx"]},
+    ]
+    manifest = tmp_path / "manifest.jsonl"
+    manifest.write_text("\n".join(json.dumps(job) for job in jobs))
+    monkeypatch.setattr("sys.stdin", StringIO("wrong\n"))
+
+    assert cli.main(["batch", str(manifest), "--password-stdin"]) == 2
+    out, err = capsys.readouterr()
+    events = {e.get("job", "all"): e for e in map(json.loads, out.splitlines())}
+    assert not events["own"]["differs"]
+    assert json.loads(err)["job"] == "stdin"
+
+
+def _sleep_job(job):
+    time.sleep(job["sleep"])
+    return job["sleep"]
+
+
+def test_run_jobs_stops_jobs_over_their_timeout():
+    started = time.monotonic()
+    jobs = [{"sleep": 30, "timeout": 0.5}, {"sleep": 0}]
+    outcomes = [(status, result) for _, status, result in run_jobs(_sleep_job, jobs, 2)]
+    assert outcomes == [("ok", 0), ("timeout", None)]
+    assert time.monotonic() - started < 10
+
+
+def test_cli_reports_missing_password(monkeypatch, capsys):
+    monkeypatch.delenv("KPD_PASSWORD", raising=False)
+    assert cli.main(["diff", "a.kdbx", "b.kdbx"]) == 2
+    assert "KPD_PASSWORD" in capsys.readouterr().err
+
+
+def test_compare_many_groups_copies_by_uuid_and_path():
+    def snap(uuid, path, fingerprint):
+        return EntrySnapshot(uuid, path, fingerprint, {"password": fingerprint})
+
+    databases = [
+        {"a": snap(1, "a", b"1"), "b": snap(2, "b", b"1")},
+        {"a": snap(1, "a", b"1"), "moved/b": snap(2, "moved/b", b"1")},
+        {"a": snap(3, "a", b"2"), "c": snap(4, "c", b"1")},
+    ]
+    comparison = compare_many(databases, ["laptop", "phone", "tablet"])
+    entries = {entry["path"]: entry for entry in comparison["entries"]}
+
+    assert entries["a"]["present_in"] == ["laptop", "phone", "tablet"]
+    assert entries["a"]["versions"] == [["laptop", "phone"], ["tablet"]]
+    assert entries["a"]["fields"] == ["password"]
+    assert entries["b"]["moved"] and entries["b"]["missing_from"] == ["tablet"]
+    assert entries["c"]["present_in"] == ["tablet"]
+    assert comparison["summary"] == {
+        "entries": 3,
+        "in_all": 1,
+        "identical": 0,
+        "diverged": 1,
+    }
+
+
+def test_compare_many_never_takes_two_copies_from_one_database():
+    def snap(uuid, path, fingerprint):
+        return EntrySnapshot(uuid, path, fingerprint, {"password": fingerprint})
+
+    # The entry of the first database moved to Q, a new one took its path
+    databases = [
+        {"P": snap(1, "P", b"1")},
+        {"P": snap(2, "P", b"2"), "Q": snap(1, "Q", b"1")},
+    ]
+    comparison = compare_many(databases, ["db1", "db2"])
+    rows = sorted(comparison["entries"], key=lambda entry: entry["paths"]["db2"])
+
+    assert [row["paths"] for row in rows] == [{"db2": "P"}, {"db1": "P", "db2": "Q"}]
+    assert rows[1]["moved"] and rows[1]["versions"] == [["db1", "db2"]]
+    assert rows[0]["versions"] == [["db2"]]
+
+
+def test_open_and_export_in_memory(tmp_path, monkeypatch):
+    db_file_path = create_sample_db(entries=[{"title": "foo"}])
+    with open(db_file_path, "rb") as f:
+        upload = BytesIO(f.read())
+
+    monkeypatch.chdir(tmp_path)
+    kp = open_database_bytes(upload.getvalue(), "test")
+    kp.add_entry(kp.root_group, "bar", "u", "p")
+    exported = export_database(kp)
+
+    assert list(tmp_path.iterdir()) == []
+    reopened = open_database_bytes(exported, "test")
+    assert get_entries_set(reopened)["entries"] == {"foo", "bar"}
+
+
+def test_path_listing_filters_and_pages():
+    listing = PathListing(
+        ["work/mail", "work/vpn", "home/mail", "home/bank", "root entry", "workshop"]
+    )
+
+    assert listing.filter(prefix="work/") == ["work/mail", "work/vpn"]
+    assert listing.filter(title="MAIL") == ["home/mail", "work/mail"]
+    assert listing.filter(group="home", title="bank") == ["home/bank"]
+    assert listing.filter(prefix="work", group="") == ["workshop"]
+    assert listing.groups == ["", "home", "work"]
+
+    assert page_slice(list(range(120)), 3, 50) == (list(range(100, 120)), 3)
+    assert page_slice(list(range(120)), 9, 50)[0] == list(range(100, 120))
+    assert page_slice([], 1, 50) == ([], 1)
+
+
+def test_generate_vault_pair_is_reproducible(tmp_path):
+    first = tmp_path / "first"
+    second = tmp_path / "second"
+    first.mkdir()
+    second.mkdir()
+    kdf = {"I": 2, "M": 1024 * 1024, "P": 1}
+    options = dict(
+        entries=40, overlap=0.5, changed=0.5, kdf=kdf, password="test", seed=7
+    )
+
+    kps = [
+        PyKeePass(path, password="test")
+        for path in generate_vault_pair(str(first), **options)
+        + generate_vault_pair(str(second), **options)
+    ]
+    sets = [get_entries_set(kp) for kp in kps]
+    differences = compare_databases(sets[0], sets[1])
+
+    assert sets[0] == sets[2] and sets[1] == sets[3]
+    assert len(sets[0]["entries"]) == 40
+    assert len(differences["common_entries"]) == 20
+    assert len(differences["entries_only_in_db2"]) == 20
+    # Reopened with the KDF parameters they were written with
+    parameters = kps[0].kdbx.header.value.dynamic_header.kdf_parameters.data.dict
+    assert {name: parameters[name].value for name in kdf} == kdf
+
+
+def test_profiler_records_nested_spans_and_calls_hooks(setup_databases):
+    kp1, kp2 = setup_databases
+    hooked = []
+    profiler = profiling.Profiler()
+    profiling.add_hook(hooked.append)
+    try:
+        with profiler.activate():
+            with profiling.span("stage"):
+                blob = bytearray(1024 * 1024)
+                compare_databases(get_entries_set(kp1), get_entries_set(kp2))
+                del blob
+    finally:
+        profiling.remove_hook(hooked.append)
+
+    names = [span.name for span in profiler.spans]
+    assert names == ["index_database", "index_database", "compare_databases", "stage"]
+    assert [span.name for span in hooked] == names
+    stage = profiler.spans[-1]
+    assert stage.peak_bytes >= 1024 * 1024
+    assert stage.wall_seconds >= sum(s.wall_seconds for s in profiler.spans[:-1])
+    assert {row["name"]: row["count"] for row in profiler.summary()} == {
+        "index_database": 2,
+        "compare_databases": 1,
+        "stage": 1,
+    }